@@ -14,9 +14,13 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import collections
+import concurrent.futures
+import itertools
 import os
 import os.path
 
+from contextlib import contextmanager
+
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GObject
@@ -42,6 +46,15 @@ AC_FDS_MASK = actions.ActionCondns.new_flags_and_mask(4)
 AC_ONLY_FILES_SELECTED = AC_FILES_SELECTED|AC_NO_DIRS_SELECTED
 AC_ONLY_DIRS_SELECTED = AC_DIRS_SELECTED|AC_NO_FILES_SELECTED
 
+def iter_batches(iterable, batch_size):
+    """Yield the items in "iterable" in lists of (up to) batch_size items"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            break
+        yield batch
+
 def get_masked_seln_conditions(seln):
     if seln is None:
         return actions.MaskedCondns(AC_NO_FILES_SELECTED|AC_NO_DIRS_SELECTED, AC_FDS_MASK)
@@ -63,23 +76,38 @@ def get_masked_seln_conditions(seln):
     else:
         return actions.MaskedCondns(AC_NO_FILES_SELECTED|AC_NO_DIRS_SELECTED, AC_FDS_MASK)
 
-class FileTreeModel(Gtk.TreeStore, enotify.Listener, auto_update.AutoUpdater, actions.BGUserMixin):
-    # NB: this model is volatile/lazy and should only have one associated View
-    # as the contenst are dependent on the state of the View
-    # NB: the use of a Gtk.TreeStoreFilter has been considered as an
-    # alternative mechanism for implementing show_hidden/hide_clean has
-    # been rejected as being unable to handle empty
-    # directories properly
+class _FileTreeModelMixin(enotify.Listener, auto_update.AutoUpdater, actions.BGUserMixin):
+    # NB: what FileTreeModel and VirtualFileTreeModel have in common i.e.
+    # everything that doesn't depend on how their rows are stored
     REPOPULATE_EVENTS = enotify.E_CHANGE_WD
     UPDATE_EVENTS = os_utils.E_FILE_CHANGES
     AU_FILE_CHANGE_EVENT = os_utils.E_FILE_CHANGES # event returned by auto_update() if changes found
-    @staticmethod
-    def _get_file_db():
-        return fsdb.OsFileDb()
+    USE_INOTIFY = False # use inotify (where available) rather than polling to detect changes
+    USE_TREE_CACHE = False # start up from (and save) a persistent cache of the populated tree
+    PREFETCH_DEPTH = 0 # levels below an expanded directory to populate in the background (0 = off)
+    PREFETCH_POOL_SIZE = 2 # number of worker threads used for prefetching
+    ASYNC_AUTO_UPDATE = False # check the file db's currency (and prepare its reset) in a worker thread
+    CURRENCY_CHECK_BUDGET = None # (max dirs, max msecs) of the file db to check per auto update tick (None = all of it)
+    @classmethod
+    def _get_file_db_options(cls):
+        # NB: children's _get_file_db() should pass these to their
+        # (OsFileDb or GenericSnapshotWsFileDb based) db
+        return dict(use_inotify=cls.USE_INOTIFY, use_tree_cache=cls.USE_TREE_CACHE)
+    @classmethod
+    def _get_file_db(cls):
+        return fsdb.OsFileDb(**cls._get_file_db_options())
     def __init__(self):
         assert (self.REPOPULATE_EVENTS & self.UPDATE_EVENTS) == 0
         self._view = None
-        Gtk.TreeStore.__init__(self, GObject.TYPE_PYOBJECT)
+        self._file_db = None
+        self._prefetch_pool = None
+        self._currency_pool = None
+        self._currency_check = None
+        self._currency_checker = None
+        self._async_auto_update = self.ASYNC_AUTO_UPDATE
+        # the paths of the expanded directories (in the order they were
+        # expanded) kept up to date by the view's signals
+        self._expanded_dir_paths = {}
         enotify.Listener.__init__(self)
         self.add_notification_cb(self.REPOPULATE_EVENTS, self.repopulate)
         self.add_notification_cb(self.UPDATE_EVENTS, self.update)
@@ -89,6 +117,18 @@ class FileTreeModel(Gtk.TreeStore, enotify.Listener, auto_update.AutoUpdater, ac
     # Make it safe to use this in a Dialog.
     def _destroy(self, *args):
         self._view = None
+        if self.USE_TREE_CACHE and isinstance(self._file_db, fsdb.OsFileDb):
+            try:
+                self._file_db.save_tree_cache()
+            except OSError:
+                pass # it's only a cache
+        if self._prefetch_pool is not None:
+            self._prefetch_pool.shutdown(wait=False)
+            self._prefetch_pool = None
+        if self._currency_pool is not None:
+            self._currency_pool.shutdown(wait=False)
+            self._currency_pool = None
+        self._set_file_db(None)
         self.auto_updater_destroy_cb(*args)
         self.listener_destroy_cb(*args)
     def set_view(self, view):
@@ -126,34 +166,25 @@ class FileTreeModel(Gtk.TreeStore, enotify.Listener, auto_update.AutoUpdater, ac
     def _toggle_show_buttons_cb(self, toggleaction):
         with self._view.showing_busy():
             self.update_dir("", None)
-    def insert_place_holder(self, dir_iter):
-        self.append(dir_iter)
-    def insert_place_holder_if_needed(self, dir_iter):
-        if self.iter_n_children(dir_iter) == 0:
-            self.insert_place_holder(dir_iter)
-    def recursive_remove(self, fsobj_iter):
-        child_iter = self.iter_children(fsobj_iter)
-        if child_iter != None:
-            while self.recursive_remove(child_iter):
-                pass
-        return self.remove(fsobj_iter)
-    def repopulate(self, **kwargs):
-        with self._view.showing_busy():
-            self._file_db = self._get_file_db()
-            self.clear()
-            self._populate_dir("", self.get_iter_first())
     def update(self, fsdb_reset_only=False, **kwargs):
         with self._view.showing_busy():
-            self._file_db = self._file_db.reset() if (fsdb_reset_only and self in fsdb_reset_only) else self._get_file_db()
-            self.update_dir("", None)
-    def depopulate(self, dir_iter):
-        child_iter = self.iter_children(dir_iter)
-        if child_iter != None:
-            if self.get_value(child_iter, 0) is None:
-                return # already depopulated and placeholder in place
-            while self.recursive_remove(child_iter):
-                pass
-        self.insert_place_holder(dir_iter)
+            self._currency_checker = None
+            if fsdb_reset_only and self in fsdb_reset_only:
+                self._set_file_db(self._file_db.reset())
+                change_set = self._file_db.change_set
+            else:
+                self._set_file_db(self._get_file_db())
+                change_set = None
+            if change_set is None:
+                self.update_dir("", None)
+            else:
+                self.apply_change_set(change_set)
+    def _set_file_db(self, file_db):
+        # NB: the old db is closed rather than left to the garbage
+        # collector as it may hold an inotify instance
+        if self._file_db is not None and self._file_db is not file_db:
+            self._file_db.close()
+        self._file_db = file_db
     def get_iter_for_filepath(self, filepath):
         # NB: assumes filepath starts with "./"
         pathparts = fsdb.split_path(filepath)[1:]
@@ -172,16 +203,203 @@ class FileTreeModel(Gtk.TreeStore, enotify.Listener, auto_update.AutoUpdater, ac
                 return child_iter
             child_iter = self.iter_next(child_iter)
         return None
+    def _find_dir_iter(self, dir_path):
+        # NB: unlike get_iter_for_filepath() this doesn't expand any rows
+        dir_iter = None
+        for name in fsdb.split_path(dir_path)[1:]:
+            child_iter = self.iter_children(dir_iter)
+            while child_iter is not None:
+                fsobj = self.get_value(child_iter, 0)
+                if fsobj is not None and fsobj.is_dir and fsobj.name == name:
+                    break
+                child_iter = self.iter_next(child_iter)
+            if child_iter is None:
+                return (False, None)
+            dir_iter = child_iter
+        return (True, dir_iter)
     def get_fsi_path(self, model_iter):
         return os.path.relpath(self[model_iter][0].path)
+    def iter_file_paths_in_dir(self, dir_path, show_hidden=False, hide_clean=False, recursive=True, batch_size=None):
+        """Return an iterator over the paths of the files in "dir_path"
+        (depth first) or, if "batch_size" is given, over lists of (up to)
+        that many of them
+        """
+        file_paths = self._iter_file_paths_in_dir(self._file_db, dir_path, show_hidden, hide_clean, recursive)
+        return file_paths if batch_size is None else iter_batches(file_paths, batch_size)
+    @staticmethod
+    def _iter_file_paths_in_dir(file_db, dir_path, show_hidden, hide_clean, recursive):
+        # NB: an explicit stack avoids a chain of nested generators
+        dir_paths = [dir_path]
+        while dir_paths:
+            subdirs, files = file_db.dir_contents(dir_paths.pop(), show_hidden=show_hidden, hide_clean=hide_clean)
+            for fdata in files:
+                yield fdata.path
+            if recursive:
+                dir_paths.extend(reversed([subdir.path for subdir in subdirs]))
     def get_file_paths_in_dir(self, dir_path, show_hidden=False, hide_clean=False, recursive=True):
         # TODO: fix get_file_paths_in_dir() -- use model not db
-        subdirs, files = self._file_db.dir_contents(dir_path, show_hidden=show_hidden, hide_clean=hide_clean)
-        file_paths = [fdata.path for fdata in files]
-        if recursive:
-            for subdir in subdirs:
-                file_paths += self.get_file_paths_in_dir(subdir.path, show_hidden=show_hidden, hide_clean=hide_clean, recursive=recursive)
-        return file_paths
+        return list(self.iter_file_paths_in_dir(dir_path, show_hidden=show_hidden, hide_clean=hide_clean, recursive=recursive))
+    def find_file_paths(self, query, max_results=20):
+        """Return the paths of the files in the file db that best match
+        "query" (best first) for "go to file"
+        """
+        return self._file_db.find_file_paths(query, max_results)
+    def is_file_path_shown(self, file_path):
+        """Return whether "file_path" (and the directories leading to
+        it) is shown in the current view mode e.g. not hidden
+        """
+        # NB: assumes file_path starts with "./"
+        pathparts = fsdb.split_path(file_path)[1:]
+        dir_path = ""
+        for index, name in enumerate(pathparts):
+            dirs, files = self._file_db.get_dir_view(dir_path, show_hidden=self.show_hidden, hide_clean=self.hide_clean)
+            if not any(data.name == name for data in (files if index == len(pathparts) - 1 else dirs)):
+                return False
+            dir_path = os.path.join(dir_path, name)
+        return True
+    def _prefetch_subdirs(self, dir_path, depth):
+        # Scan the unpopulated subdirectories in worker threads so that
+        # expanding them later is instant.  The results are installed
+        # in the file db by the main loop (see _prefetch_done_cb()).
+        if depth < 1:
+            return
+        file_db = self._file_db
+        subdirs = file_db.get_unpopulated_subdirs(dir_path, show_hidden=self.show_hidden, hide_clean=self.hide_clean)
+        if not subdirs:
+            return
+        if self._prefetch_pool is None:
+            self._prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.PREFETCH_POOL_SIZE)
+        for subdir in subdirs:
+            future = self._prefetch_pool.submit(subdir.scan)
+            future.add_done_callback(lambda future, subdir=subdir: GObject.idle_add(self._prefetch_done_cb, file_db, subdir, future, depth - 1))
+    def _prefetch_done_cb(self, file_db, subdir, future, depth):
+        # NB: discard results that are no longer relevant
+        if self._view is None or file_db is not self._file_db or future.cancelled() or future.exception() is not None:
+            return False
+        # NB: reset() keeps the db but may have dropped (or replaced) the
+        # directory in which case installing the scan would corrupt the db
+        if file_db.find_dir(subdir.data.path) is not subdir:
+            return False
+        subdir.install_scan(future.result())
+        self._prefetch_subdirs(os.path.relpath(subdir.data.path), depth)
+        return False
+    def _get_dir_contents(self, dirpath):
+        return self._file_db.dir_contents(dirpath, show_hidden=self.show_hidden, hide_clean=self.hide_clean)
+    @staticmethod
+    def _check_currency(file_db):
+        # NB: this runs in a worker thread so mustn't touch the model
+        if file_db.is_current:
+            return True
+        file_db.prepare_reset()
+        return False
+    def _start_currency_check(self):
+        if self._currency_check is not None:
+            return # the last one is still running
+        if self._currency_pool is None:
+            self._currency_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        file_db = self._file_db
+        self._currency_check = self._currency_pool.submit(self._check_currency, file_db)
+        self._currency_check.add_done_callback(lambda future: GObject.idle_add(self._currency_check_done_cb, file_db, future))
+    def _currency_check_done_cb(self, file_db, future):
+        self._currency_check = None
+        # NB: discard results that are no longer relevant
+        if self._view is None or file_db is not self._file_db or future.cancelled():
+            return False
+        exc = future.exception()
+        if exc is not None:
+            # NB: the db being updated during the check (e.g. "dictionary
+            # changed size during iteration") is expected and the check
+            # is just done again but anything else is a bug so it's
+            # reported and the checks are done in the main loop (where
+            # exceptions aren't lost) from now on
+            if not isinstance(exc, RuntimeError):
+                self._async_auto_update = False
+                dialogue.ask_for_bug_report((type(exc), exc, exc.__traceback__))
+            return False
+        if not future.result():
+            enotify.notify_events(self.AU_FILE_CHANGE_EVENT, fsdb_reset_only=[self])
+        return False
+    def _note_row_expanded(self, dir_iter):
+        self._expanded_dir_paths[self.get_fsi_path(dir_iter)] = True
+    def _note_row_collapsed(self, dir_iter):
+        # NB: the view forgets which rows below it were expanded
+        dir_path = self.get_fsi_path(dir_iter)
+        prefix = dir_path + os.sep
+        for a_dir_path in [p for p in self._expanded_dir_paths if p == dir_path or p.startswith(prefix)]:
+            del self._expanded_dir_paths[a_dir_path]
+    def _check_currency_within_budget(self):
+        if self._currency_checker is None or self._currency_checker.file_db is not self._file_db:
+            self._currency_checker = fsdb.CurrencyChecker(self._file_db)
+        max_dirs, max_msecs = self.CURRENCY_CHECK_BUDGET
+        # NB: what the user can see is checked first
+        return self._currency_checker.check(max_dirs, max_msecs, self._expanded_dir_paths)
+    def auto_update(self, events_so_far, args):
+        if events_so_far & (self.REPOPULATE_EVENTS|self.UPDATE_EVENTS):
+            return 0
+        if self._async_auto_update:
+            # NB: any changes will be notified by _currency_check_done_cb()
+            self._start_currency_check()
+            return 0
+        if self.CURRENCY_CHECK_BUDGET is not None:
+            # NB: None means the check isn't complete (so no news yet)
+            if self._check_currency_within_budget() is not False:
+                return 0
+        elif self._file_db.is_current:
+            return 0
+        try:
+            args["fsdb_reset_only"].append(self)
+        except KeyError:
+            args["fsdb_reset_only"] = [self]
+        return self.AU_FILE_CHANGE_EVENT
+
+class FileTreeModel(Gtk.TreeStore, _FileTreeModelMixin):
+    # NB: this model is volatile/lazy and should only have one associated View
+    # as the contenst are dependent on the state of the View
+    # NB: the use of a Gtk.TreeStoreFilter has been considered as an
+    # alternative mechanism for implementing show_hidden/hide_clean has
+    # been rejected as being unable to handle empty
+    # directories properly
+    DETACH_EDITS_THRESHOLD = 1000 # make bigger updates with the model detached from the view (None = never)
+    def __init__(self):
+        Gtk.TreeStore.__init__(self, GObject.TYPE_PYOBJECT)
+        _FileTreeModelMixin.__init__(self)
+    def insert_place_holder(self, dir_iter):
+        self.append(dir_iter)
+    def insert_place_holder_if_needed(self, dir_iter):
+        if self.iter_n_children(dir_iter) == 0:
+            self.insert_place_holder(dir_iter)
+    def recursive_remove(self, fsobj_iter):
+        child_iter = self.iter_children(fsobj_iter)
+        if child_iter != None:
+            while self.recursive_remove(child_iter):
+                pass
+        return self.remove(fsobj_iter)
+    def repopulate(self, **kwargs):
+        with self._view.showing_busy():
+            self._set_file_db(self._get_file_db())
+            self._currency_checker = None
+            self._expanded_dir_paths = {}
+            self.clear()
+            self._populate_dir("", self.get_iter_first())
+    def apply_change_set(self, change_set):
+        # only visit the directories that the file db says have changed
+        # NB: sorting means parents are dealt with before their children
+        for dir_path in sorted(change_set):
+            found, dir_iter = self._find_dir_iter(dir_path)
+            if not found:
+                continue # not currently in the model so nothing to do
+            if dir_iter is None or self._view.row_expanded(self.get_path(dir_iter)):
+                self.update_dir(os.path.relpath(dir_path), dir_iter, recursive=False)
+            else:
+                self.depopulate(dir_iter)
+    def depopulate(self, dir_iter):
+        child_iter = self.iter_children(dir_iter)
+        if child_iter != None:
+            if self.get_value(child_iter, 0) is None:
+                return # already depopulated and placeholder in place
+            while self.recursive_remove(child_iter):
+                pass
+        self.insert_place_holder(dir_iter)
     def remove_place_holder(self, dir_iter):
         child_iter = self.iter_children(dir_iter)
         if child_iter and self.get_value(child_iter, 0) is None:
@@ -192,14 +410,15 @@ class FileTreeModel(Gtk.TreeStore, enotify.Listener, auto_update.AutoUpdater, ac
             return child_iter is None or self.get_value(child_iter, 0) is None
         return False
     def on_row_expanded_cb(self, view, dir_iter, _dummy):
+        self._note_row_expanded(dir_iter)
         if self._not_yet_populated(dir_iter):
             self._populate_dir(self.get_fsi_path(dir_iter), dir_iter)#(self[dir_iter][0].path, dir_iter)
             if self.iter_n_children(dir_iter) > 1:
                 self.remove_place_holder(dir_iter)
+        self._prefetch_subdirs(self.get_fsi_path(dir_iter), self.PREFETCH_DEPTH)
     def on_row_collapsed_cb(self, _view, dir_iter, _dummy):
+        self._note_row_collapsed(dir_iter)
         self.insert_place_holder_if_needed(dir_iter)
-    def _get_dir_contents(self, dirpath):
-        return self._file_db.dir_contents(dirpath, show_hidden=self.show_hidden, hide_clean=self.hide_clean)
     def _populate_dir(self, dirpath, parent_iter):
         dirs, files = self._get_dir_contents(dirpath)
         for dirdata in dirs:
@@ -213,93 +432,435 @@ class FileTreeModel(Gtk.TreeStore, enotify.Listener, auto_update.AutoUpdater, ac
             dummy = self.append(parent_iter, [filedata])
         if parent_iter is not None:
             self.insert_place_holder_if_needed(parent_iter)
-    def update_dir(self, dirpath, parent_iter):
+    def update_dir(self, dirpath, parent_iter, recursive=True):
+        # NB: all the edits are worked out before any are made so that a
+        # big batch of them can be made with the model detached from the
+        # view (rather than it reacting to each row's signals)
+        edits = []
+        changed = self._get_dir_edits(dirpath, parent_iter, recursive, edits)
+        if self.DETACH_EDITS_THRESHOLD is None or len(edits) <= self.DETACH_EDITS_THRESHOLD or self._view.AUTO_EXPAND:
+            for edit, args in edits:
+                edit(*args)
+        else:
+            with self._view_detached():
+                for edit, args in edits:
+                    edit(*args)
+        return changed
+    def _get_dir_edits(self, dirpath, parent_iter, recursive, edits):
         # TODO: make sure we cater for case where dir becomes file and vice versa in a single update
+        # NB: this only reads the model (and each row's value only once)
+        def next_child(model_iter):
+            model_iter = self.iter_next(model_iter)
+            return (model_iter, None if model_iter is None else self.get_value(model_iter, 0))
         changed = False
         place_holder_iter = None
         if parent_iter is None:
             child_iter = self.get_iter_first()
         else:
             child_iter = self.iter_children(parent_iter)
-            if child_iter:
-                if self.get_value(child_iter, 0) is None:
-                    place_holder_iter = child_iter.copy()
-                    child_iter = self.iter_next(child_iter)
+        child_data = None if child_iter is None else self.get_value(child_iter, 0)
+        if parent_iter is not None and child_iter is not None and child_data is None:
+            place_holder_iter = child_iter
+            child_iter, child_data = next_child(child_iter)
         dirs, files = self._get_dir_contents(dirpath)
+        n_entries = 0
         dead_entries = []
         for dirdata in dirs:
-            while (child_iter is not None) and self.get_value(child_iter, 0).is_dir and (self.get_value(child_iter, 0).name < dirdata.name):
+            n_entries += 1
+            while (child_data is not None) and child_data.is_dir and (child_data.name < dirdata.name):
                 dead_entries.append(child_iter)
-                child_iter = self.iter_next(child_iter)
-            if child_iter is None:
-                dir_iter = self.append(parent_iter, [dirdata])
+                child_iter, child_data = next_child(child_iter)
+            if (child_data is None) or (not child_data.is_dir) or (child_data.name > dirdata.name):
+                edits.append((self._insert_dir, (parent_iter, child_iter, dirpath, dirdata)))
                 changed = True
-                if self._view.AUTO_EXPAND:
-                    self.update_dir(os.path.join(dirpath, dirdata.name), dir_iter)
-                    self._view.expand_row(self.get_path(dir_iter), True)
-                else:
-                    self.insert_place_holder(dir_iter)
                 continue
-            name = self.get_value(child_iter, 0).name
-            if (not self.get_value(child_iter, 0).is_dir) or (name > dirdata.name):
-                dir_iter = self.insert_before(parent_iter, child_iter, [dirdata])
+            if child_data != dirdata:
+                edits.append((self.set_value, (child_iter, 0, dirdata)))
                 changed = True
-                if self._view.AUTO_EXPAND:
-                    self.update_dir(os.path.join(dirpath, dirdata.name), dir_iter)
-                    self._view.expand_row(self.get_path(dir_iter), True)
-                else:
-                    self.insert_place_holder(dir_iter)
-                continue
-            changed |= self.get_value(child_iter, 0) != dirdata
-            self.set_value(child_iter, 0, dirdata)
             # This is an update so ignore EXPAND_ALL for existing directories
             # BUT update them if they"re already expanded
             if self._view.row_expanded(self.get_path(child_iter)):
-                changed |= self.update_dir(os.path.join(dirpath, name), child_iter)
+                if recursive:
+                    changed |= self._get_dir_edits(os.path.join(dirpath, child_data.name), child_iter, recursive, edits)
             else:
                 # make sure we don"t leave bad data in children that were previously expanded
-                self.depopulate(child_iter)
-            child_iter = self.iter_next(child_iter)
-        while (child_iter is not None) and self.get_value(child_iter, 0).is_dir:
+                grandchild_iter = self.iter_children(child_iter)
+                if grandchild_iter is None or self.get_value(grandchild_iter, 0) is not None:
+                    edits.append((self.depopulate, (child_iter,)))
+            child_iter, child_data = next_child(child_iter)
+        while (child_data is not None) and child_data.is_dir:
             dead_entries.append(child_iter)
-            child_iter = self.iter_next(child_iter)
+            child_iter, child_data = next_child(child_iter)
         for filedata in files:
-            while (child_iter is not None) and (self.get_value(child_iter, 0).name < filedata.name):
+            n_entries += 1
+            while (child_data is not None) and (child_data.name < filedata.name):
                 dead_entries.append(child_iter)
-                child_iter = self.iter_next(child_iter)
-            if child_iter is None:
-                dummy = self.append(parent_iter, [filedata])
+                child_iter, child_data = next_child(child_iter)
+            if (child_data is None) or (child_data.name > filedata.name):
+                # NB: a None sibling means append
+                edits.append((self.insert_before, (parent_iter, child_iter, [filedata])))
                 changed = True
                 continue
-            if self.get_value(child_iter, 0).name > filedata.name:
-                dummy = self.insert_before(parent_iter, child_iter, [filedata])
+            if child_data != filedata:
+                edits.append((self.set_value, (child_iter, 0, filedata)))
                 changed = True
-                continue
-            changed |= self.get_value(child_iter, 0) != filedata
-            self.set_value(child_iter, 0, filedata)
-            child_iter = self.iter_next(child_iter)
+            child_iter, child_data = next_child(child_iter)
         while child_iter is not None:
             dead_entries.append(child_iter)
             child_iter = self.iter_next(child_iter)
         changed |= len(dead_entries) > 0
-        for dead_entry in dead_entries:
-            self.recursive_remove(dead_entry)
+        # NB: removing a row from a Gtk.TreeStore also removes its children
+        edits.extend((self.remove, (dead_entry,)) for dead_entry in dead_entries)
         if parent_iter is not None:
-            n_children = self.iter_n_children(parent_iter)
-            if n_children == 0:
-                self.insert_place_holder(parent_iter)
-            elif place_holder_iter is not None and n_children > 1:
-                assert self.get_value(place_holder_iter, 0) is None
-                self.remove(place_holder_iter)
+            if n_entries == 0:
+                if place_holder_iter is None:
+                    edits.append((self.insert_place_holder, (parent_iter,)))
+            elif place_holder_iter is not None:
+                edits.append((self.remove, (place_holder_iter,)))
         return changed
-    def auto_update(self, events_so_far, args):
-        if (events_so_far & (self.REPOPULATE_EVENTS|self.UPDATE_EVENTS)) or self._file_db.is_current:
-            return 0
+    def _insert_dir(self, parent_iter, sibling_iter, dirpath, dirdata):
+        dir_iter = self.insert_before(parent_iter, sibling_iter, [dirdata])
+        if self._view.AUTO_EXPAND:
+            self.update_dir(os.path.join(dirpath, dirdata.name), dir_iter)
+            self._view.expand_row(self.get_path(dir_iter), True)
+        else:
+            self.insert_place_holder(dir_iter)
+    @contextmanager
+    def _view_detached(self):
+        # NB: the view forgets which rows were expanded and selected (and
+        # where it was scrolled to) so they're restored (by file path as
+        # rows may have come and gone)
+        view = self._view
+        get_data_path = lambda tree_path: self.get_value(self.get_iter(tree_path), 0).path
+        expanded_dir_paths = []
+        view.map_expanded_rows(lambda _view, tree_path, data: data.append(get_data_path(tree_path)), expanded_dir_paths)
+        _model, selected_tree_paths = view.get_selection().get_selected_rows()
+        selected_paths = [get_data_path(tree_path) for tree_path in selected_tree_paths]
+        cursor_tree_path, _column = view.get_cursor()
+        cursor_path = None if cursor_tree_path is None else get_data_path(cursor_tree_path)
+        vadj_value = view.get_vadjustment().get_value()
+        view.set_model(None)
         try:
-            args["fsdb_reset_only"].append(self)
-        except KeyError:
-            args["fsdb_reset_only"] = [self]
-        return self.AU_FILE_CHANGE_EVENT
+            yield
+        finally:
+            view.set_model(self)
+            iters = self._get_iters_for_paths(expanded_dir_paths + selected_paths + [cursor_path])
+            # NB: parents precede their children in expanded_dir_paths
+            for dir_path in expanded_dir_paths:
+                dir_iter = iters.get(dir_path, None)
+                if dir_iter is not None:
+                    view.expand_row(self.get_path(dir_iter), False)
+            if iters.get(cursor_path, None) is not None:
+                view.set_cursor(self.get_path(iters[cursor_path]), None, False)
+            seln = view.get_selection()
+            seln.unselect_all()
+            for path in selected_paths:
+                if iters.get(path, None) is not None:
+                    seln.select_iter(iters[path])
+            # NB: after the view has laid out the restored rows
+            GObject.idle_add(lambda: view.get_vadjustment().set_value(vadj_value) and False)
+    def _get_iters_for_paths(self, paths):
+        # Return the iters for those of (data) "paths" that are in the
+        # model from one walk down just the branches leading to them
+        wanted = set(paths)
+        branches = set()
+        for path in wanted:
+            dir_path = os.path.dirname(path) if path else ""
+            while dir_path and dir_path not in branches:
+                branches.add(dir_path)
+                dir_path = os.path.dirname(dir_path)
+        iters = {}
+        dir_iters = [None]
+        while dir_iters:
+            child_iter = self.iter_children(dir_iters.pop())
+            while child_iter is not None:
+                data = self.get_value(child_iter, 0)
+                if data is not None:
+                    if data.path in wanted:
+                        iters[data.path] = child_iter
+                    if data.is_dir and data.path in branches:
+                        dir_iters.append(child_iter)
+                child_iter = self.iter_next(child_iter)
+        return iters
+
+class _DirRows:
+    # The rows (visible subdirectories then files) served for a directory
+    # by a VirtualFileTreeModel: the file db's own lists (so they're not
+    # copied) except while an update is being signalled
+    __slots__ = ("key", "parent", "name", "dir_path", "dirs", "files", "subdir_rows")
+    def __init__(self, key, parent, name, dir_path):
+        self.key = key
+        self.parent = parent
+        self.name = name
+        self.dir_path = dir_path
+        self.dirs = []
+        self.files = []
+        # those for the subdirectories that have been asked for by name
+        self.subdir_rows = {}
+    def __len__(self):
+        return len(self.dirs) + len(self.files)
+    def __getitem__(self, index):
+        n_dirs = len(self.dirs)
+        return self.dirs[index] if index < n_dirs else self.files[index - n_dirs]
+    def index_of_dir(self, name):
+        # NB: the dirs are sorted by name
+        lo, hi = 0, len(self.dirs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.dirs[mid].name < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+class VirtualFileTreeModel(GObject.Object, Gtk.TreeModel, _FileTreeModelMixin):
+    """An alternative to FileTreeModel that serves rows straight from the
+    file db's (per directory) lists on demand rather than copying them
+    into a Gtk.TreeStore.  So there are no placeholder rows and, beyond
+    the db, memory is only used for the directories that are expanded.
+    """
+    # NB: like FileTreeModel this should only have one associated View
+    def __init__(self):
+        GObject.Object.__init__(self)
+        self._stamp = id(self) & 0x7FFFFFFF
+        self._dir_rows_by_key = {}
+        self._dir_rows_keys = itertools.count(1)
+        self._top_rows = None
+        # the db's base FileDir that the rows' lists were last taken from
+        self._db_base_dir = None
+        _FileTreeModelMixin.__init__(self)
+    def _new_dir_rows(self, parent, name, dir_path):
+        dir_rows = _DirRows(next(self._dir_rows_keys), parent, name, dir_path)
+        self._dir_rows_by_key[dir_rows.key] = dir_rows
+        return dir_rows
+    def _forget_dir_rows(self, dir_rows):
+        del self._dir_rows_by_key[dir_rows.key]
+        for subdir_rows in dir_rows.subdir_rows.values():
+            self._forget_dir_rows(subdir_rows)
+    def _get_subdir_rows(self, dir_rows, index):
+        # NB: rows are fetched from the db when first asked for
+        ddata = dir_rows.dirs[index]
+        subdir_rows = dir_rows.subdir_rows.get(ddata.name, None)
+        if subdir_rows is None:
+            subdir_rows = dir_rows.subdir_rows[ddata.name] = self._new_dir_rows(dir_rows, ddata.name, os.path.relpath(ddata.path))
+            subdir_rows.dirs, subdir_rows.files = self._get_dir_view(subdir_rows.dir_path)
+        return subdir_rows
+    def _get_dir_view(self, dir_path):
+        return self._file_db.get_dir_view(dir_path, show_hidden=self.show_hidden, hide_clean=self.hide_clean)
+    def _find_dir_rows(self, dir_path):
+        # NB: unlike _get_subdir_rows() this doesn't fetch anything
+        # NB: accept both "./a/b" (as in change sets) and "a/b"
+        dir_rows = self._top_rows
+        for name in fsdb.split_path(os.path.normpath(dir_path)):
+            if name == ".":
+                continue
+            if dir_rows is None:
+                break
+            dir_rows = dir_rows.subdir_rows.get(name, None)
+        return dir_rows
+    def _make_iter(self, dir_rows, index):
+        # NB: offsets of 1 as NULL user data pointers come back as None
+        model_iter = Gtk.TreeIter()
+        model_iter.stamp = self._stamp
+        model_iter.user_data = dir_rows.key
+        model_iter.user_data2 = index + 1
+        return model_iter
+    def _get_location(self, model_iter):
+        return (self._dir_rows_by_key[model_iter.user_data], model_iter.user_data2 - 1)
+    def _get_tree_path(self, dir_rows, index):
+        indices = [index]
+        while dir_rows.parent is not None:
+            indices.append(dir_rows.parent.index_of_dir(dir_rows.name))
+            dir_rows = dir_rows.parent
+        indices.reverse()
+        return Gtk.TreePath.new_from_indices(indices)
+    def _get_child_rows(self, parent_iter):
+        if parent_iter is None:
+            return self._top_rows
+        dir_rows, index = self._get_location(parent_iter)
+        if index >= len(dir_rows.dirs):
+            return None
+        return self._get_subdir_rows(dir_rows, index)
+    # Gtk.TreeModel interface
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags(0)
+    def do_get_n_columns(self):
+        return 1
+    def do_get_column_type(self, index):
+        return GObject.TYPE_PYOBJECT
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+        dir_rows = self._top_rows
+        if dir_rows is None or not indices:
+            return (False, None)
+        for index in indices[:-1]:
+            if index >= len(dir_rows.dirs):
+                return (False, None)
+            dir_rows = self._get_subdir_rows(dir_rows, index)
+        if indices[-1] >= len(dir_rows):
+            return (False, None)
+        return (True, self._make_iter(dir_rows, indices[-1]))
+    def do_get_path(self, model_iter):
+        return self._get_tree_path(*self._get_location(model_iter))
+    def do_get_value(self, model_iter, column):
+        dir_rows, index = self._get_location(model_iter)
+        return dir_rows[index]
+    def do_iter_next(self, model_iter):
+        dir_rows, index = self._get_location(model_iter)
+        if index + 1 >= len(dir_rows):
+            return False
+        model_iter.user_data2 = index + 2
+        return True
+    def do_iter_previous(self, model_iter):
+        dir_rows, index = self._get_location(model_iter)
+        if index == 0:
+            return False
+        model_iter.user_data2 = index
+        return True
+    def do_iter_children(self, parent_iter):
+        return self.do_iter_nth_child(parent_iter, 0)
+    def do_iter_has_child(self, model_iter):
+        dir_rows, index = self._get_location(model_iter)
+        if index >= len(dir_rows.dirs):
+            return False
+        subdir_rows = dir_rows.subdir_rows.get(dir_rows.dirs[index].name, None)
+        # NB: don't fetch the rows (populating the directory) just to see
+        return True if subdir_rows is None else len(subdir_rows) > 0
+    def do_iter_n_children(self, model_iter):
+        dir_rows = self._get_child_rows(model_iter)
+        return 0 if dir_rows is None else len(dir_rows)
+    def do_iter_nth_child(self, parent_iter, n):
+        dir_rows = self._get_child_rows(parent_iter)
+        if dir_rows is None or n >= len(dir_rows):
+            return (False, None)
+        return (True, self._make_iter(dir_rows, n))
+    def do_iter_parent(self, child_iter):
+        dir_rows, _index = self._get_location(child_iter)
+        if dir_rows.parent is None:
+            return (False, None)
+        return (True, self._make_iter(dir_rows.parent, dir_rows.parent.index_of_dir(dir_rows.name)))
+    # Updating: the model's lists are changed a row at a time with the
+    # matching signal emitted after each (as the view requires)
+    def _delete_row(self, dir_rows, rows, index, offset):
+        data = rows.pop(index)
+        if data.is_dir:
+            subdir_rows = dir_rows.subdir_rows.pop(data.name, None)
+            if subdir_rows is not None:
+                self._forget_dir_rows(subdir_rows)
+        self.row_deleted(self._get_tree_path(dir_rows, offset + index))
+    def _insert_row(self, dir_rows, rows, index, offset, data):
+        rows.insert(index, data)
+        model_iter = self._make_iter(dir_rows, offset + index)
+        path = self._get_tree_path(dir_rows, offset + index)
+        self.row_inserted(path, model_iter)
+        if data.is_dir:
+            self.row_has_child_toggled(path, model_iter)
+    def _merge_rows(self, dir_rows, new_rows, is_dirs):
+        # NB: both lists are sorted by name
+        rows = list(dir_rows.dirs if is_dirs else dir_rows.files)
+        if is_dirs:
+            dir_rows.dirs = rows
+        else:
+            dir_rows.files = rows
+        offset = 0 if is_dirs else len(dir_rows.dirs)
+        changed = False
+        index = 0
+        for data in new_rows:
+            while index < len(rows) and rows[index].name < data.name:
+                self._delete_row(dir_rows, rows, index, offset)
+                changed = True
+            if index < len(rows) and rows[index].name == data.name:
+                if rows[index] != data:
+                    rows[index] = data
+                    self.row_changed(self._get_tree_path(dir_rows, offset + index), self._make_iter(dir_rows, offset + index))
+                    changed = True
+                else:
+                    # NB: no need to signal a change the view can't show
+                    rows[index] = data
+            else:
+                self._insert_row(dir_rows, rows, index, offset, data)
+                changed = True
+            index += 1
+        while index < len(rows):
+            self._delete_row(dir_rows, rows, index, offset)
+            changed = True
+        # now that they're the same go back to sharing the db's list
+        if is_dirs:
+            dir_rows.dirs = new_rows
+        else:
+            dir_rows.files = new_rows
+        return changed
+    def _update_rows(self, dir_rows, recursive):
+        new_dirs, new_files = self._get_dir_view(dir_rows.dir_path)
+        changed = False
+        # NB: the db only replaces a directory's lists when it changes
+        if new_dirs is not dir_rows.dirs or new_files is not dir_rows.files:
+            had_rows = len(dir_rows) > 0
+            changed |= self._merge_rows(dir_rows, new_dirs, True)
+            changed |= self._merge_rows(dir_rows, new_files, False)
+            if dir_rows.parent is not None and had_rows != (len(dir_rows) > 0):
+                index = dir_rows.parent.index_of_dir(dir_rows.name)
+                self.row_has_child_toggled(self._get_tree_path(dir_rows.parent, index), self._make_iter(dir_rows.parent, index))
+        if recursive:
+            for subdir_rows in list(dir_rows.subdir_rows.values()):
+                changed |= self._update_rows(subdir_rows, recursive)
+        return changed
+    def repopulate(self, **kwargs):
+        with self._view.showing_busy():
+            if self._top_rows is not None:
+                # NB: removing the top level rows removes everything
+                self._merge_rows(self._top_rows, [], False)
+                self._merge_rows(self._top_rows, [], True)
+                self._dir_rows_by_key = {}
+            self._set_file_db(self._get_file_db())
+            self._currency_checker = None
+            self._expanded_dir_paths = {}
+            self._top_rows = self._new_dir_rows(None, "", "")
+            self._update_rows(self._top_rows, recursive=False)
+            self._db_base_dir = self._file_db.find_dir("")
+            if self._view.AUTO_EXPAND:
+                self._view.expand_all()
+    def update_dir(self, dirpath, parent_iter=None, recursive=True):
+        # NB: "parent_iter" is only for compatibility with FileTreeModel
+        dir_rows = self._find_dir_rows(dirpath)
+        if dir_rows is None:
+            return False
+        changed = self._update_rows(dir_rows, recursive)
+        if changed and self._view.AUTO_EXPAND:
+            self._view.expand_all()
+        return changed
+    def apply_change_set(self, change_set):
+        # only the directories whose rows have been asked for matter
+        # NB: sorting means parents are dealt with before their children
+        for dir_path in sorted(change_set):
+            self.update_dir(dir_path, recursive=False)
+        base_dir = self._file_db.find_dir("")
+        if base_dir is not self._db_base_dir:
+            # the db rebuilt its tree so the unchanged directories' rows
+            # are still the old tree's lists (keeping it alive)
+            self._db_base_dir = base_dir
+            self._repoint_rows()
+    def _repoint_rows(self):
+        # NB: parents first so that any merge sees its parent's new rows
+        for dir_rows in sorted(self._dir_rows_by_key.values(), key=lambda dr: dr.dir_path.count(os.sep) + bool(dr.dir_path)):
+            if self._dir_rows_by_key.get(dir_rows.key, None) is not dir_rows:
+                continue # forgotten by an earlier merge
+            new_dirs, new_files = self._get_dir_view(dir_rows.dir_path)
+            if new_dirs == dir_rows.dirs and new_files == dir_rows.files:
+                # NB: only the lists' identities change so no signals
+                dir_rows.dirs, dir_rows.files = new_dirs, new_files
+            else:
+                self._update_rows(dir_rows, recursive=False)
+    def on_row_expanded_cb(self, view, dir_iter, _dummy):
+        self._note_row_expanded(dir_iter)
+        self._prefetch_subdirs(self.get_fsi_path(dir_iter), self.PREFETCH_DEPTH)
+    def on_row_collapsed_cb(self, _view, dir_iter, _dummy):
+        self._note_row_collapsed(dir_iter)
+        # NB: the view has discarded the rows below so we can too
+        dir_rows, index = self._get_location(dir_iter)
+        subdir_rows = dir_rows.subdir_rows.pop(dir_rows.dirs[index].name, None)
+        if subdir_rows is not None:
+            self._forget_dir_rows(subdir_rows)
 
 def tv_icon_set_func(treeviewcolumn, cell, model, tree_iter, *args):
     file_data = model.get_value(tree_iter, 0)
@@ -404,6 +965,7 @@ class FileTreeView(tlview.View, actions.CAGandUIManager, doop.DoOperationMixin):
     </ui>
     """
     AUTO_EXPAND = False
+    GO_TO_FILE_CANDIDATES = 20 # best matches looked through for one that's shown by go_to_file()
     DIRS_SELECTABLE = True
     ASK_BEFORE_DELETE = True
     OPEN_NEW_FILES_FOR_EDIT = True
@@ -485,24 +1047,57 @@ class FileTreeView(tlview.View, actions.CAGandUIManager, doop.DoOperationMixin):
         else:
             return model[path][0] and not model[path][0].is_dir
     def select_filepaths(self, filepaths):
+        # Return those of filepaths that were selected
         seln = self.get_selection()
         seln.unselect_all()
+        first_iter = None
+        selected = []
         for filepath in filepaths:
-            seln.select_iter(self.model.get_iter_for_filepath(filepath))
+            model_iter = self.model.get_iter_for_filepath(filepath)
+            if model_iter is None:
+                continue # not shown in the current view (e.g. hidden)
+            seln.select_iter(model_iter)
+            selected.append(filepath)
+            if first_iter is None:
+                first_iter = model_iter
+        if first_iter is not None:
+            self.scroll_to_cell(self.model.get_path(first_iter), None, False, 0.0, 0.0)
+        return selected
+    def go_to_file(self, query):
+        """Expand to and select the file best matching "query" that's
+        shown in the current view mode and return its path (or None if
+        there's no such file)
+        """
+        # NB: the first search populates the whole file db
+        with self.showing_busy():
+            file_paths = self.model.find_file_paths(query, max_results=self.GO_TO_FILE_CANDIDATES)
+        # NB: the index includes hidden (e.g. ignored) files
+        for file_path in file_paths:
+            if self.model.is_file_path_shown(file_path):
+                return file_path if self.select_filepaths([file_path]) else None
+        return None
     def get_selected_fsi_path(self):
         store, selection = self.get_selection().get_selected_rows()
         assert len(selection) == 1
         return store.get_fsi_path(selection[0])
-    def get_selected_file_paths(self, expanded=True):
+    def iter_selected_file_paths(self, expanded=True, batch_size=None):
+        """Return an iterator over the paths of the selected files (and,
+        if "expanded", of the files in the selected directories) or, if
+        "batch_size" is given, over lists of (up to) that many of them
+        """
         store, selection = self.get_selection().get_selected_rows()
-        file_path_list = list()
+        file_paths = self._iter_selected_file_paths(store, selection, expanded)
+        return file_paths if batch_size is None else iter_batches(file_paths, batch_size)
+    @staticmethod
+    def _iter_selected_file_paths(store, selection, expanded):
         for x in selection:
             if store[x][0].is_dir:
                 if expanded:
-                    file_path_list += self.model.get_file_paths_in_dir(store.get_fsi_path(x), show_hidden=store.show_hidden, hide_clean=store.hide_clean, recursive=True)
+                    yield from store.iter_file_paths_in_dir(store.get_fsi_path(x), show_hidden=store.show_hidden, hide_clean=store.hide_clean, recursive=True)
             else:
-                file_path_list.append(store.get_fsi_path(x))
-        return file_path_list
+                yield store.get_fsi_path(x)
+    def get_selected_file_paths(self, expanded=True):
+        return list(self.iter_selected_file_paths(expanded=expanded))
     def get_selected_fsi_paths(self):
         store, selection = self.get_selection().get_selected_rows()
         return [store.get_fsi_path(x) for x in selection]
@@ -564,6 +1159,10 @@ class FileTreeView(tlview.View, actions.CAGandUIManager, doop.DoOperationMixin):
             return self.do_op_rename_overwrite_force_or_cancel(target, do_op, get_target)
         return CmdResult.ok()
 
+class VirtualFileTreeView(FileTreeView):
+    # NB: for very large trees where copying rows into a TreeStore hurts
+    MODEL = VirtualFileTreeModel
+
 class FileTreeWidget(Gtk.VBox, enotify.Listener):
     MENUBAR = "/files_menubar"
     BUTTON_BAR_ACTIONS = ["show_hidden_files"]
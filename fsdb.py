@@ -13,9 +13,21 @@
 ### along with this program; if not, write to the Free Software
 ### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import array
+import bisect
 import collections
+import copy
+import heapq
+import itertools
+import mmap
 import os
 import hashlib
+import re
+import stat
+import struct
+import sys
+import threading
+import time
 
 import gi
 gi.require_version("Gtk", "3.0")
@@ -25,6 +37,13 @@ from gi.repository import Gtk
 from ..bab.nmd_tuples import PathAndRelation as RFD
 from ..bab.nmd_tuples import StyleAndForeground as Deco
 
+try:
+    from .. import CONFIG_DIR_PATH
+except ImportError:
+    from ... import CONFIG_DIR_PATH
+
+from . import inotify
+
 FSTATUS_IGNORED = " "
 
 _STATUS_DECO_MAP = {
@@ -32,39 +51,161 @@ _STATUS_DECO_MAP = {
     FSTATUS_IGNORED: Deco(Pango.Style.ITALIC, "grey"),
 }
 
-class FileData(collections.namedtuple("FileData", ["path", "status", "related_file_data"])):
-    is_dir = False
-    icon = Gtk.STOCK_FILE
+class _NodeData:
+    # NB: file dbs hold one of these for every file and directory in the
+    # tree so they are kept compact: no per instance dict, interned names
+    # and the path of the containing directory shared (by reference) with
+    # all its siblings.  Full paths are built on demand.  Children should
+    # declare (empty) __slots__ to keep this benefit.
+    __slots__ = ("_dir_path", "name", "status", "related_file_data", "_stat_key")
     STATUS_DECO_MAP = _STATUS_DECO_MAP
+    @classmethod
+    def in_dir(cls, dir_path, name, *args, **kwargs):
+        """Create the data for "name" in "dir_path" without the need to
+        join and then split the path
+        """
+        data = cls.__new__(cls)
+        data._set(dir_path, name, *args, **kwargs)
+        return data
+    def _set(self, dir_path, name, status=None, related_file_data=None):
+        self._dir_path = sys.intern(dir_path)
+        self.name = sys.intern(name)
+        self.status = status
+        self.related_file_data = related_file_data
+        self._stat_key = None
     @property
-    def name(self):
-        return os.path.basename(self.path)
+    def path(self):
+        return os.path.join(self._dir_path, self.name)
     @property
     def deco(self):
         return self.STATUS_DECO_MAP[self.status]
     @property
     def status_str(self):
         return self.status
+    def _fetch_stat_key(self):
+        # NB: only the (st_ino, st_size, st_mtime_ns) are kept as they're
+        # cached for every file that's been stat()ed
+        try:
+            fstat = os.stat(self.path)
+        except OSError:
+            return None
+        return (fstat.st_ino, fstat.st_size, fstat.st_mtime_ns)
+    @property
+    def stat_key(self):
+        # NB: fetched on first use and cached thereafter
+        if self._stat_key is None:
+            self._stat_key = self._fetch_stat_key()
+        return self._stat_key
+    @property
+    def size(self):
+        stat_key = self.stat_key
+        return None if stat_key is None else stat_key[1]
+    def refresh_stat(self):
+        """Refetch the cached stat (if there is one) and return True if
+        the file's size or modification time has changed
+        """
+        old_stat_key = self._stat_key
+        if old_stat_key is None:
+            return False
+        self._stat_key = self._fetch_stat_key()
+        return self._stat_key != old_stat_key
+    @property
+    def content_digest(self):
+        # NB: always fresh (unlike "stat") but only reread if changed
+        return CONTENT_DIGEST_CACHE.get_digest(self.path)
+    def _key(self):
+        return (self._dir_path, self.name, self.status, self.related_file_data)
+    # NB: the cached stat isn't significant for comparisons
+    def __eq__(self, other):
+        return isinstance(other, _NodeData) and self.is_dir == other.is_dir and self._key() == other._key()
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __hash__(self):
+        return hash(self._key())
+    def __lt__(self, other):
+        if self._dir_path is other._dir_path:
+            # siblings (the usual case): no need to build the paths
+            return self.name < other.name
+        return self.path < other.path
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join("{}={!r}".format(field, getattr(self, field)) for field in self._FIELDS))
 
-class DirData(collections.namedtuple("DirData", FileData._fields + ("clean_status",))):
+class FileData(_NodeData):
+    __slots__ = ()
+    _FIELDS = ("path", "status", "related_file_data")
+    is_dir = False
+    icon = Gtk.STOCK_FILE
+    def __init__(self, path, status=None, related_file_data=None):
+        self._set(*os.path.split(path), status=status, related_file_data=related_file_data)
+
+# NB: "clean_status" must stay in fourth place as children use positional construction
+class DirData(_NodeData):
+    __slots__ = ("clean_status",)
+    _FIELDS = ("path", "status", "related_file_data", "clean_status")
     is_dir = True
     icon = Gtk.STOCK_DIRECTORY
-    STATUS_DECO_MAP = _STATUS_DECO_MAP
-    @property
-    def name(self):
-        return os.path.basename(self.path)
-    @property
-    def deco(self):
-        return self.STATUS_DECO_MAP[self.status]
+    def __init__(self, path, status=None, related_file_data=None, clean_status=None):
+        self._set(*os.path.split(path), status=status, related_file_data=related_file_data, clean_status=clean_status)
+    def _set(self, dir_path, name, status=None, related_file_data=None, clean_status=None):
+        _NodeData._set(self, dir_path, name, status, related_file_data)
+        self.clean_status = clean_status
     @property
     def clean_deco(self):
         return self.STATUS_DECO_MAP[self.clean_status]
     @property
-    def status_str(self):
-        return self.status
-    @property
     def clean_status_str(self):
         return self.clean_status
+    def _key(self):
+        return (self._dir_path, self.name, self.status, self.related_file_data, self.clean_status)
+
+# Changes to the contents of a directory (lists of FileData/DirData)
+DirChanges = collections.namedtuple("DirChanges", ["added", "removed", "modified"])
+
+def get_dir_changes(old_data_list, new_data_list):
+    """Return the differences between two lists of FileData/DirData for
+    the same directory (or None if there are none)
+    """
+    old_data = {data.path: data for data in old_data_list}
+    added = []
+    modified = []
+    for data in new_data_list:
+        old = old_data.pop(data.path, None)
+        if old is None:
+            added.append(data)
+        elif old != data:
+            modified.append(data)
+    if added or modified or old_data:
+        return DirChanges(added, list(old_data.values()), modified)
+    return None
+
+# Aggregates for the (known part of the) tree below a directory:
+# "status_counts" counts files by status and "is_complete" is False if
+# some of its directories haven't been populated yet.  NB: "n_bytes" is
+# as of when the stats were read after the last reset()
+DirStats = collections.namedtuple("DirStats", ["n_files", "n_dirs", "n_bytes", "status_counts", "is_complete"])
+
+def get_dir_stats(files_data, subdirs):
+    """Return the DirStats for a directory containing "files_data" and
+    the FileDirs "subdirs" (whose own stats are used)
+    """
+    # NB: each file is stat()ed (once) to get its size
+    n_bytes = sum(size for size in (fdata.size for fdata in files_data) if size is not None)
+    status_counts = collections.Counter(fdata.status for fdata in files_data)
+    n_files = len(files_data)
+    n_dirs = 0
+    is_complete = True
+    for subdir in subdirs:
+        n_dirs += 1
+        sub_stats = subdir.stats
+        if sub_stats is None:
+            is_complete = False
+            continue
+        n_files += sub_stats.n_files
+        n_dirs += sub_stats.n_dirs
+        n_bytes += sub_stats.n_bytes
+        status_counts.update(sub_stats.status_counts)
+        is_complete = is_complete and sub_stats.is_complete
+    return DirStats(n_files, n_dirs, n_bytes, status_counts, is_complete)
 
 # Contained File Relative Data
 CFRD = collections.namedtuple("CFRD", ["subdir_relpath", "name"])
@@ -78,42 +219,678 @@ def split_path(path):
     parts = []
     while path:
         path, tail = os.path.split(path)
-        parts.insert(0, tail)
+        parts.append(tail)
+    parts.reverse()
     return parts
 
 def file_path_belongs_here(file_path, base_dir_path=None):
     return not os.path.relpath(file_path, os.curdir if base_dir_path is None else base_dir_path).startswith(os.pardir)
 
+# Helpers for children that stream the output of SCM commands (rather
+# than fetching it as text) so that it is hashed and parsed as it's read
+def iter_chunks(file_obj, chunk_size=65536):
+    """Yield the data read from the binary file object (e.g. a pipe)
+    "file_obj" in chunks as soon as they are available
+    """
+    read = file_obj.read1 if hasattr(file_obj, "read1") else file_obj.read
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def iter_nul_records(chunks, h=None):
+    """Yield (as bytes) the NUL terminated records (e.g. the output of
+    "git status -z") in the stream of bytes "chunks" (updating "h" with
+    the data as it passes if it's supplied)
+    """
+    # NB: splitting each chunk as a whole is much faster in CPython than
+    # yielding a memoryview slice per record
+    tail = b""
+    for chunk in chunks:
+        if h is not None:
+            h.update(chunk)
+        records = (tail + chunk if tail else chunk).split(b"\0")
+        # NB: the last record may be continued in the next chunk
+        tail = records.pop()
+        yield from records
+    if tail:
+        yield tail
+
+# Directory change detection strategies: each returns a token that will
+# be different if the directory's list of entries has changed (or None
+# if the directory can't be read)
+def get_dir_stat_token(dir_path):
+    # NB: adding, removing or renaming an entry updates the directory's
+    # mtime and replacing the directory changes its inode
+    try:
+        dstat = os.stat(dir_path)
+    except OSError:
+        return None
+    return (dstat.st_mtime_ns, dstat.st_ino, dstat.st_nlink)
+
+def get_dir_listing_digest(dir_path):
+    h = hashlib.sha1()
+    try:
+        for item in os.listdir(dir_path):
+            h.update(item.encode())
+    except OSError:
+        return None
+    return h.digest()
+
+def _translate_ignore_pattern(pattern):
+    # NB: patterns containing a "/" (other than a trailing one which
+    # has already been removed) are relative to the ignore file's
+    # directory and the others may match at any level below it
+    anchored = "/" in pattern
+    if pattern.startswith("/"):
+        pattern = pattern[1:]
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        char = pattern[i]
+        if char == "*" and pattern.startswith("**", i) and (i == 0 or pattern[i - 1] == "/") and (i + 2 == n or pattern[i + 2] == "/"):
+            if i + 2 == n:
+                parts.append(".*")
+                i += 2
+            else:
+                parts.append("(?:.*/)?")
+                i += 3
+            continue
+        if char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j == -1:
+                parts.append(re.escape(char))
+            else:
+                body = pattern[i + 1:j]
+                parts.append("[^" + body[1:] + "]" if body[0] in "!^" else "[" + body + "]")
+                i = j
+        elif char == "\\" and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return ("".join(parts), anchored)
+
+class IgnoreRules:
+    """The gitignore style rules from one ignore file compiled into a
+    regex for names and one for paths (for each of files and
+    directories) so that matching needs no per rule loop
+    """
+    def __init__(self, lines):
+        blocks = []
+        for line in lines:
+            # NB: trailing spaces are ignored unless escaped
+            stripped = line.rstrip(" ")
+            if stripped.endswith("\\") and len(stripped) < len(line):
+                stripped += " "
+            line = stripped
+            if not line or line[0] == "#":
+                continue
+            negated = line[0] == "!"
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            regex, anchored = _translate_ignore_pattern(line)
+            if not blocks or blocks[-1][0] != negated:
+                # (negated, file name, file path, dir name, dir path) regexes
+                blocks.append((negated, [], [], [], []))
+            if not dir_only:
+                blocks[-1][2 if anchored else 1].append(regex)
+            blocks[-1][4 if anchored else 3].append(regex)
+        # NB: the last matching rule wins so the runs of (negated or
+        # not) rules are put in reverse order (each in its own group) so
+        # that the lowest numbered group to match is the one that counts
+        blocks.reverse()
+        self._negated = [None] + [block[0] for block in blocks]
+        self._file_res = (self._compile(blocks, 1), self._compile(blocks, 2))
+        self._dir_res = (self._compile(blocks, 3), self._compile(blocks, 4))
+    @staticmethod
+    def _compile(blocks, index):
+        if not any(block[index] for block in blocks):
+            return None
+        return re.compile("|".join("(" + ("|".join(block[index]) if block[index] else "(?!)") + ")" for block in blocks))
+    def __bool__(self):
+        return len(self._negated) > 1
+    @classmethod
+    def load(cls, file_path):
+        """Return the rules in "file_path" (or None if it can't be read)"""
+        try:
+            with open(file_path, "r", errors="surrogateescape") as f_obj:
+                return cls(f_obj.read().splitlines())
+        except OSError:
+            return None
+    def match(self, dir_prefix, name, is_dir):
+        """Return True if "name" in the directory whose path relative to
+        the ignore file's directory is "dir_prefix" ("" or "/" separated
+        and "/" terminated) is ignored, False if it's explicitly not
+        ignored (by a "!" rule) and None if no rule matches it
+        """
+        name_re, path_re = self._dir_res if is_dir else self._file_res
+        group = None
+        if name_re is not None:
+            match = name_re.fullmatch(name)
+            if match is not None:
+                group = match.lastindex
+        if path_re is not None:
+            match = path_re.fullmatch(dir_prefix + name)
+            if match is not None and (group is None or match.lastindex < group):
+                group = match.lastindex
+        return None if group is None else not self._negated[group]
+
+class InotifyDirMonitor:
+    """Use inotify to learn which populated FileDirs have changed (and
+    so avoid polling the file system) with a fall back to polling for
+    any directories that can't be watched e.g. when the watch limit has
+    been reached.
+    """
+    def __init__(self):
+        self._watcher = inotify.DirWatcher()
+        self._polled_dirs = set()
+        # those marked dirty since take_stale_dirs() was last called
+        self._dirty_dirs = set()
+        self._changed = False
+    @classmethod
+    def new_if_available(cls):
+        try:
+            return cls()
+        except OSError:
+            return None
+    def watch(self, file_dir):
+        if self._watcher.add_watch(file_dir.data.path, file_dir):
+            return True
+        self._polled_dirs.add(file_dir)
+        return False
+    def forget(self, file_dirs):
+        self._watcher.remove_watches(file_dirs)
+        self._polled_dirs.difference_update(file_dirs)
+        self._dirty_dirs.difference_update(file_dirs)
+    def _mark_changed_dirs(self):
+        for file_dir in self._watcher.read_changed_keys():
+            file_dir._is_dirty = True
+            self._dirty_dirs.add(file_dir)
+            self._changed = True
+    @property
+    def is_current(self):
+        self._mark_changed_dirs()
+        if self._changed or self._watcher.overflowed:
+            return False
+        for file_dir in self._polled_dirs:
+            if file_dir._get_current_change_token() != file_dir._change_token:
+                return False
+        return True
+    def mark_changed(self, file_dir):
+        # NB: for changes that happened before file_dir was watched
+        file_dir._is_dirty = True
+        self._dirty_dirs.add(file_dir)
+        self._changed = True
+    def prepare_for_refresh(self):
+        """Bring the FileDirs' dirty flags up to date before they're
+        refreshed.  Return False if events have been lost and the dirty
+        flags can't be relied upon.
+        """
+        self._mark_changed_dirs()
+        self._changed = False
+        return not self._watcher.overflowed
+    def take_stale_dirs(self):
+        """Return the FileDirs that may have changed since the last call
+        (those marked dirty and the polled ones whose change token has
+        changed) so that they're all that need to be refreshed
+        """
+        stale_dirs, self._dirty_dirs = self._dirty_dirs, set()
+        stale_dirs.update(file_dir for file_dir in self._polled_dirs if file_dir._get_current_change_token() != file_dir._change_token)
+        return stale_dirs
+    def reset(self):
+        self._watcher.remove_all_watches()
+        self._polled_dirs = set()
+        self._dirty_dirs = set()
+        self._changed = False
+    def close(self):
+        # NB: don't leave it to the garbage collector as the watcher and
+        # the FileDirs (its keys) refer to each other
+        self._watcher.close()
+        self._polled_dirs = set()
+        self._dirty_dirs = set()
+
+class TreeCache:
+    """A compact (memory mapped) binary record of the entries in the
+    populated directories of a file db (keyed by their stat change
+    tokens) so that a new db for the same tree can be populated without
+    scanning the directories.  Entries are only served for directories
+    whose change token still matches.
+    """
+    # File layout: MAGIC, dir count then for each directory a record of
+    # header (path length, token, entry count, names length), path,
+    # one is_dir flag byte per entry and the NUL separated entry names
+    MAGIC = b"PMFTC\x00\x00\x01"
+    _COUNT = struct.Struct("<I")
+    _DIR_HDR = struct.Struct("<HqQQII")
+    def __init__(self, mmapped_data, index):
+        self._data = mmapped_data
+        self._index = index
+    @staticmethod
+    def get_path_for_dir(dir_path):
+        name = hashlib.sha1(os.fsencode(os.path.abspath(dir_path))).hexdigest()
+        return os.path.join(CONFIG_DIR_PATH, "tree_cache", name)
+    @classmethod
+    def load(cls, cache_path):
+        # NB: a missing or corrupt cache just means that there's no cache
+        try:
+            with open(cache_path, "rb") as f_obj:
+                data = mmap.mmap(f_obj.fileno(), 0, access=mmap.ACCESS_READ)
+            if data[:len(cls.MAGIC)] != cls.MAGIC:
+                return None
+            offset = len(cls.MAGIC)
+            n_dirs, = cls._COUNT.unpack_from(data, offset)
+            offset += cls._COUNT.size
+            index = {}
+            for _i in range(n_dirs):
+                path_len, mtime_ns, ino, nlink, n_entries, names_len = cls._DIR_HDR.unpack_from(data, offset)
+                offset += cls._DIR_HDR.size
+                path = os.fsdecode(data[offset:offset + path_len])
+                offset += path_len
+                index[path] = ((mtime_ns, ino, nlink), offset, n_entries, names_len)
+                offset += n_entries + names_len
+        except (OSError, ValueError, struct.error):
+            return None
+        return cls(data, index)
+    def get_entries(self, dir_path, change_token):
+        try:
+            token, offset, n_entries, names_len = self._index[dir_path]
+        except KeyError:
+            return None
+        if token != change_token:
+            return None
+        if n_entries == 0:
+            return []
+        flags = self._data[offset:offset + n_entries]
+        names = self._data[offset + n_entries:offset + n_entries + names_len].decode(sys.getfilesystemencoding(), "surrogateescape").split("\0")
+        return [(name, flag == 1) for name, flag in zip(names, flags)]
+    @classmethod
+    def save(cls, cache_path, file_dirs):
+        records = []
+        for file_dir in file_dirs:
+            token = file_dir._change_token
+            # NB: only stat change tokens mean anything in another session
+            if not (isinstance(token, tuple) and len(token) == 3):
+                continue
+            path = os.fsencode(file_dir.data.path)
+            data_list = file_dir._subdirs_data + file_dir._files_data
+            flags = bytes(1 if data.is_dir else 0 for data in data_list)
+            names = b"\0".join(os.fsencode(data.name) for data in data_list)
+            records.append(cls._DIR_HDR.pack(len(path), token[0], token[1], token[2], len(data_list), len(names)))
+            records += [path, flags, names]
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # NB: write to a temporary file and move it into place so that
+        # any mapped version of the old file remains valid
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as f_obj:
+            f_obj.write(cls.MAGIC)
+            f_obj.write(cls._COUNT.pack(len(records) // 4))
+            f_obj.write(b"".join(records))
+        os.replace(tmp_path, cache_path)
+
+class ContentDigestCache:
+    """An LRU cache of the (SHA1) digests of the contents of files keyed
+    by their (st_dev, st_ino, st_size, st_mtime_ns) so that files that
+    haven't changed needn't be reread to find out.  If "store_path" is
+    given the cache is loaded from (and save() writes it to) that file.
+    """
+    MAGIC = b"PMCDC\x00\x00\x01"
+    _RECORD = struct.Struct("<QQQq20s")
+    # NB: a file modified this recently could be modified again without
+    # its mtime changing so its digest isn't kept
+    RACY_INTERVAL_NS = 2000000000
+    def __init__(self, max_entries=8192, store_path=None):
+        self._max_entries = max_entries
+        self._store_path = store_path
+        self._digests = collections.OrderedDict()
+        # NB: file dbs may be used from worker threads
+        self._lock = threading.Lock()
+        if store_path is not None:
+            self._load()
+    @staticmethod
+    def _get_key(fstat):
+        return (fstat.st_dev, fstat.st_ino, fstat.st_size, fstat.st_mtime_ns)
+    def get_digest(self, file_path):
+        """Return the digest of the contents of "file_path" (or None if
+        it isn't a readable regular file)
+        """
+        try:
+            fstat = os.stat(file_path)
+            if not stat.S_ISREG(fstat.st_mode):
+                return None
+            key = self._get_key(fstat)
+            with self._lock:
+                digest = self._digests.get(key, None)
+                if digest is not None:
+                    self._digests.move_to_end(key)
+                    return digest
+            h = hashlib.sha1()
+            with open(file_path, "rb") as f_obj:
+                for chunk in iter(lambda: f_obj.read(65536), b""):
+                    h.update(chunk)
+                changed = self._get_key(os.fstat(f_obj.fileno())) != key
+        except OSError:
+            return None
+        digest = h.digest()
+        if not changed and time.time_ns() - fstat.st_mtime_ns >= self.RACY_INTERVAL_NS:
+            with self._lock:
+                self._digests[key] = digest
+                if len(self._digests) > self._max_entries:
+                    self._digests.popitem(last=False)
+        return digest
+    def has_changed(self, file_path, old_stat_key, new_stat_key):
+        """Return whether the contents of "file_path" changed between
+        its "old_stat_key" and "new_stat_key" (see FileData.stat_key).
+        NB: if the digest for the old one isn't in the cache the
+        contents are assumed to have changed.
+        """
+        if old_stat_key is None or new_stat_key is None or old_stat_key == new_stat_key:
+            return False
+        try:
+            st_dev = os.stat(file_path).st_dev
+        except OSError:
+            return False
+        with self._lock:
+            old_digest = self._digests.get((st_dev,) + old_stat_key, None)
+        # NB: this also caches the new digest for next time
+        new_digest = self.get_digest(file_path)
+        return old_digest is None or new_digest != old_digest
+    def _load(self):
+        # NB: a missing or corrupt store just means starting empty
+        try:
+            with open(self._store_path, "rb") as f_obj:
+                data = f_obj.read()
+        except OSError:
+            return
+        if data[:len(self.MAGIC)] != self.MAGIC or (len(data) - len(self.MAGIC)) % self._RECORD.size:
+            return
+        for dev, ino, size, mtime_ns, digest in self._RECORD.iter_unpack(data[len(self.MAGIC):]):
+            self._digests[(dev, ino, size, mtime_ns)] = digest
+        while len(self._digests) > self._max_entries:
+            self._digests.popitem(last=False)
+    def save(self):
+        """Write the cache (least recently used first) to its store"""
+        with self._lock:
+            records = [self._RECORD.pack(*key, digest) for key, digest in self._digests.items()]
+        os.makedirs(os.path.dirname(self._store_path), exist_ok=True)
+        tmp_path = self._store_path + ".tmp"
+        with open(tmp_path, "wb") as f_obj:
+            f_obj.write(self.MAGIC)
+            f_obj.write(b"".join(records))
+        os.replace(tmp_path, self._store_path)
+
+# NB: shared by the file dbs and the text buffers (applications may replace
+# it with one that has a persistent store)
+CONTENT_DIGEST_CACHE = ContentDigestCache()
+
+def _is_subsequence(sub, text):
+    text_iter = iter(text)
+    return all(char in text_iter for char in sub)
+
+class FileNameIndex:
+    """A trigram index of the (lower cased) names of files for fast
+    fuzzy "go to file" searches.  Files are recorded by name with the
+    directories containing a file of that name so that common names
+    (e.g. "__init__.py") are only indexed once.
+    """
+    # NB: the padding makes 1 and 2 character prefixes into trigrams
+    _PAD = "\0\0"
+    # only this many names (the shortest of those containing the
+    # query's rarest trigrams) are scored to bound the cost of queries
+    # that match a large part of the index
+    MAX_CANDIDATES = 2000
+    def __init__(self):
+        self._name_ids = {}
+        self._names = []
+        self._padded_lnames = []
+        self._name_lens = []
+        self._name_dir_paths = []
+        self._dir_name_ids = {}
+        # dir path -> paths of its subdirectories that hold (or have
+        # descendants that hold) indexed files so that a directory tree
+        # can be removed without scanning all the directories
+        self._subdir_paths = {}
+        # trigram -> ids of the names containing it shortest first (NB:
+        # names are never removed from these: those in no directories
+        # are just skipped)
+        self._postings = {}
+        self._unsorted_trigrams = set()
+        self._n_files = 0
+    def __len__(self):
+        return self._n_files
+    @staticmethod
+    def _get_trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+    def _new_name_id(self, name):
+        name_id = self._name_ids[name] = len(self._names)
+        padded_lname = self._PAD + name.lower()
+        self._names.append(name)
+        self._padded_lnames.append(padded_lname)
+        self._name_lens.append(len(name))
+        self._name_dir_paths.append([])
+        postings = self._postings
+        trigrams = self._get_trigrams(padded_lname)
+        for trigram in trigrams:
+            posting = postings.get(trigram, None)
+            if posting is None:
+                posting = postings[trigram] = array.array("I")
+            posting.append(name_id)
+        # NB: the postings are sorted when next used by a search
+        self._unsorted_trigrams.update(trigrams)
+        return name_id
+    def add_file(self, dir_path, name):
+        name_id = self._name_ids.get(name, None)
+        if name_id is None:
+            name_id = self._new_name_id(name)
+        name_ids = self._dir_name_ids.get(dir_path, None)
+        if name_ids is None:
+            self._dir_name_ids[dir_path] = {name_id}
+            self._link_dir(dir_path)
+        elif name_id not in name_ids:
+            name_ids.add(name_id)
+        else:
+            return
+        self._name_dir_paths[name_id].append(dir_path)
+        self._n_files += 1
+    def remove_file(self, dir_path, name):
+        name_id = self._name_ids.get(name, None)
+        name_ids = self._dir_name_ids.get(dir_path, ())
+        if name_id not in name_ids:
+            return
+        self._name_dir_paths[name_id].remove(dir_path)
+        name_ids.discard(name_id)
+        if not name_ids:
+            del self._dir_name_ids[dir_path]
+        self._n_files -= 1
+    def _link_dir(self, dir_path):
+        while True:
+            parent_dir_path = os.path.dirname(dir_path)
+            if not parent_dir_path or parent_dir_path == dir_path:
+                break
+            subdir_paths = self._subdir_paths.get(parent_dir_path, None)
+            if subdir_paths is not None:
+                # NB: so its ancestors are already linked
+                subdir_paths.add(dir_path)
+                break
+            self._subdir_paths[parent_dir_path] = {dir_path}
+            dir_path = parent_dir_path
+    def has_dir(self, dir_path):
+        return dir_path in self._dir_name_ids
+    def remove_dir(self, dir_path):
+        """Remove the files in "dir_path" and all directories below it"""
+        self._subdir_paths.get(os.path.dirname(dir_path), set()).discard(dir_path)
+        dir_paths = [dir_path]
+        while dir_paths:
+            a_dir_path = dir_paths.pop()
+            dir_paths.extend(self._subdir_paths.pop(a_dir_path, ()))
+            for name_id in self._dir_name_ids.pop(a_dir_path, ()):
+                self._name_dir_paths[name_id].remove(a_dir_path)
+                self._n_files -= 1
+    def _get_posting(self, trigram):
+        posting = self._postings.get(trigram, None)
+        if posting is None:
+            return ()
+        if trigram in self._unsorted_trigrams:
+            posting[:] = array.array("I", sorted(posting, key=self._name_lens.__getitem__))
+            self._unsorted_trigrams.discard(trigram)
+        return posting
+    def _rank_names(self, name_query):
+        if len(name_query) < 3:
+            trigrams = {(self._PAD + name_query)[-3:]}
+        else:
+            trigrams = self._get_trigrams(name_query)
+        # NB: names need (at least) half of the query's trigrams and a
+        # name missing no more than max_misses of them must contain one
+        # of any max_misses + 1 of them so only the names in the
+        # shortest postings need to be looked at
+        max_misses = (len(trigrams) - 1) // 2
+        postings = sorted((self._get_posting(trigram) for trigram in trigrams), key=len)[:max_misses + 1]
+        if len(postings) == 1:
+            candidates = postings[0][:self.MAX_CANDIDATES]
+        elif sum(len(posting) for posting in postings) <= self.MAX_CANDIDATES:
+            candidates = set().union(*postings)
+        else:
+            candidates = set(itertools.islice(heapq.merge(*postings, key=self._name_lens.__getitem__), self.MAX_CANDIDATES))
+        min_matches = len(trigrams) - max_misses
+        n_trigrams = len(trigrams)
+        padded_query = self._PAD + name_query
+        query_len = len(padded_query)
+        padded_lnames = self._padded_lnames
+        name_dir_paths = self._name_dir_paths
+        ranked = []
+        for name_id in candidates:
+            if not name_dir_paths[name_id]:
+                continue
+            padded_lname = padded_lnames[name_id]
+            n_matches = len([trigram for trigram in trigrams if trigram in padded_lname])
+            if n_matches < min_matches:
+                continue
+            score = n_matches / n_trigrams - len(padded_lname) / 1000
+            if name_query in padded_lname:
+                score += 1
+                if padded_lname.startswith(padded_query):
+                    score += 1
+                    if len(padded_lname) == query_len or padded_lname[query_len] == ".":
+                        score += 1
+            ranked.append((score, name_id))
+        ranked.sort(reverse=True)
+        return ranked
+    def search(self, query, max_results=20):
+        """Return the paths of (up to) "max_results" files best matching
+        "query" (best first).  Anything up to the last separator in the
+        query is matched (as a subsequence) against directory paths.
+        """
+        dir_query, _sep, name_query = query.strip().lower().rpartition(os.sep)
+        if not name_query:
+            return []
+        file_paths = []
+        for _score, name_id in self._rank_names(name_query):
+            dir_paths = self._name_dir_paths[name_id]
+            if dir_query:
+                dir_paths = [p for p in dir_paths if _is_subsequence(dir_query, p.lower())]
+            # NB: prefer shallower files when names score the same
+            for dir_path in heapq.nsmallest(max_results - len(file_paths), dir_paths, key=len):
+                file_paths.append(os.path.join(dir_path, self._names[name_id]))
+            if len(file_paths) >= max_results:
+                break
+        return file_paths
+
 class NullFileDb:
     is_current = True
+    change_set = None
     def __init__(self):
         pass
     @staticmethod
     def dir_contents(dir_path, **kwargs):
         return ([], [])
+    @staticmethod
+    def get_dir_view(dir_path, **kwargs):
+        return ([], [])
+    @staticmethod
+    def get_unpopulated_subdirs(dir_path, **kwargs):
+        return []
+    @staticmethod
+    def get_dir_stats(dir_path=""):
+        return None
+    @staticmethod
+    def find_file_paths(query, max_results=20):
+        return []
+    @staticmethod
+    def find_dir(dir_path):
+        return None
+    def prepare_reset(self):
+        pass
     def reset(self):
         return self
+    def close(self):
+        pass
 
 class OsFileDb:
     class FileDir:
         DIR_DATA = DirData
         FILE_DATA = FileData
-        def __init__(self, name=None, dir_path=None, status=None, clean_status=None, **kwargs):
+        # the gitignore style file whose rules determine which entries
+        # are FSTATUS_IGNORED (applying to its directory and below)
+        IGNORE_FILE_NAME = ".gitignore"
+        # report files whose contents have changed as "modified" in the
+        # change set made by reset().  NB: this costs a stat() per file
+        # when populating and resetting (done by prepare_reset() if it's
+        # used) and rereading those that have changed and, as only
+        # digests already in CONTENT_DIGEST_CACHE can show that a touched
+        # file hasn't really changed, a file's first change is always
+        # reported.
+        TRACK_CONTENT_CHANGES = False
+        def __init__(self, name=None, dir_path=None, status=None, clean_status=None, dir_monitor=None, tree_cache=None, dir_index=None, parent=None, **kwargs):
             # DEBUG: assert dir_path is None or os.path.basename(dir_path) == name
             dir_path = dir_path if dir_path is not None else os.curdir
+            # NB: the parent is needed to pass changes to our stats up the tree
+            self._parent = parent
+            self._stats = None
+            # whether our files have been stat()ed (for the stats)
+            self._has_file_stats = False
+            self._dir_monitor = dir_monitor
+            self._tree_cache = tree_cache
+            # NB: the db's index of all its FileDirs (by normalized path)
+            self._dir_index = dir_index
+            if dir_index is not None:
+                dir_index[_normalized_relpath(dir_path)] = self
+            self._is_watched = False
+            self._is_dirty = False
             self._is_populated = False
+            self._has_ignore_file = False
+            self._ignore_rules = None
             self._subdirs = {}
             self._files_data = []
             self._subdirs_data = []
+            # filtered (dirs, files) lists by view mode
+            self._views = {}
             status = status if status is not False else self._get_initial_status(dir_path)
             clean_status = clean_status if clean_status is not False else self._get_initial_clean_status(dir_path)
             self.data = self.DIR_DATA(dir_path, status, None, clean_status)
-            self._dir_hash_digest = None
+            self._change_token = None
+        # Children may select get_dir_listing_digest() (or their own
+        # function) if the file system's directory mtimes can't be trusted
+        get_change_token = staticmethod(get_dir_stat_token)
         def __getattr__(self, name):
             if name == "is_current": return self._is_current()
             raise AttributeError(name)
         def _is_current(self):
-            if self._get_current_hash_digest() != self._dir_hash_digest:
+            if self._get_current_change_token() != self._change_token:
                 return False
             for subdir in self._subdirs.values():
                 if subdir._is_populated and not subdir.is_current:
@@ -123,85 +900,667 @@ class OsFileDb:
         def _new_dir(cls, name, dir_path, **kwargs):
             return cls(name, dir_path, **kwargs)
         def _add_subdir(self, name, dir_path=None, status=None, clean_status=None, **kwargs):
-            self._subdirs[name] = self._new_dir(name=name, dir_path=dir_path if dir_path else os.path.join(self.data.path, name), status=status, clean_status=clean_status, **kwargs)
+            self._subdirs[name] = self._new_dir(name=name, dir_path=dir_path if dir_path else os.path.join(self.data.path, name), status=status, clean_status=clean_status, dir_monitor=self._dir_monitor, tree_cache=self._tree_cache, dir_index=self._dir_index, parent=self, **kwargs)
         def _add_file(self, name, status=None, related_file_data=None):
-            self._files_data.append(self.FILE_DATA(path=os.path.join(self.data.path, name), status=status, related_file_data=related_file_data))
-        def _get_current_hash_digest(self):
-            h = hashlib.sha1()
-            for item in os.listdir(self.data.path):
-                h.update(item.encode())
-            return h.digest()
-        def _populate(self):
-            h = hashlib.sha1()
-            for item in os.listdir(self.data.path):
-                h.update(item.encode())
-                dir_path = os.path.join(self.data.path, item)
-                if os.path.isdir(dir_path):
-                    self._add_subdir(name=item, dir_path=dir_path)
+            self._files_data.append(self.FILE_DATA.in_dir(self.data.path, name, status=status, related_file_data=related_file_data))
+        def _get_current_change_token(self):
+            return self.get_change_token(self.data.path)
+        def _start_change_tracking(self):
+            if self._dir_monitor is not None:
+                self._is_watched = self._dir_monitor.watch(self)
+        def scan(self):
+            """Return the directory's change token and (name, is_dir) for
+            each of its entries.  NB: this doesn't modify
+            self so it may be run in a worker thread.
+            """
+            change_token = self._get_current_change_token()
+            if self._tree_cache is not None:
+                entries = self._tree_cache.get_entries(self.data.path, change_token)
+                if entries is not None:
+                    return (change_token, entries)
+            with os.scandir(self.data.path) as entries:
+                # NB: scandir() gets the entry type from the directory read
+                # so (except for symbolic links) no extra stat() is needed
+                return (change_token, [(entry.name, entry.is_dir()) for entry in entries])
+        def install_scan(self, scan):
+            """Populate this directory from the result of a scan() done in
+            a worker thread (unless it's been populated in the meantime).
+            NB: the caller must check that it's still in the db (e.g. with
+            find_dir()) as a reset() may have dropped it.
+            """
+            if self._is_populated:
+                return
+            self._start_change_tracking()
+            if scan[0] != self._get_current_change_token():
+                # it changed before tracking started so the scan is stale
+                scan = None
+            self._change_token = self._populate(scan)
+        def _is_stale(self):
+            if self._is_watched:
+                return self._is_dirty
+            return self._get_current_change_token() != self._change_token
+        def _iter_dirs(self):
+            yield self
+            for subdir in self._subdirs.values():
+                yield from subdir._iter_dirs()
+        def _is_ignored(self):
+            return self.data.status == FSTATUS_IGNORED
+        def _is_hidden_dir(self, ddata):
+            return ddata.name[0] == "." or ddata.status == FSTATUS_IGNORED
+        def _is_hidden_file(self, fdata):
+            return fdata.name[0] == "." or fdata.status == FSTATUS_IGNORED
+        def _is_indexed(self):
+            # whether our files belong in the db's FileNameIndex i.e.
+            # neither we nor our ancestors are hidden (e.g. ".git") or
+            # ignored as they'd crowd out the files that can be shown
+            file_dir = self
+            while file_dir._parent is not None:
+                if file_dir._is_ignored() or file_dir._parent._is_hidden_dir(file_dir.data):
+                    return False
+                file_dir = file_dir._parent
+            return True
+        def _iter_all_dirs(self):
+            # NB: populating any that aren't (and skipping unreadable,
+            # hidden and ignored ones)
+            if not self._is_populated:
+                try:
+                    self._change_token = self._populate()
+                except OSError:
+                    return
+            yield self
+            for subdir in self._subdirs.values():
+                if not subdir._is_ignored() and not self._is_hidden_dir(subdir.data):
+                    yield from subdir._iter_all_dirs()
+        def _iter_populated_dirs(self):
+            if self._is_populated:
+                yield self
+                for subdir in self._subdirs.values():
+                    yield from subdir._iter_populated_dirs()
+        def _record_changes(self, old_data_list, change_set):
+            changes = get_dir_changes(old_data_list, self._subdirs_data + self._files_data)
+            if self.TRACK_CONTENT_CHANGES:
+                old_files_data = {data.name: data for data in old_data_list if not data.is_dir}
+                modified = [fdata for fdata in self._files_data if fdata.name in old_files_data and CONTENT_DIGEST_CACHE.has_changed(fdata.path, old_files_data[fdata.name]._stat_key, fdata.stat_key)]
+                if modified:
+                    if changes is None:
+                        changes = DirChanges([], [], [])
+                    changes.modified.extend(fdata for fdata in modified if fdata not in changes.modified)
+            if changes is not None:
+                change_set[self.data.path] = changes
+        def _stat_files(self):
+            # NB: the stats are cached in the FileData
+            for fdata in self._files_data:
+                fdata.stat_key
+            self._has_file_stats = True
+        def _find_content_changes(self):
+            # Return the (file data, old stat key, new stat key, whether
+            # its contents changed) for our files whose stat has changed.
+            # NB: this doesn't modify self so it may be run in a worker thread
+            found = []
+            for fdata in self._files_data:
+                old_stat_key = fdata._stat_key
+                new_stat_key = fdata._fetch_stat_key()
+                if new_stat_key != old_stat_key:
+                    found.append((fdata, old_stat_key, new_stat_key, CONTENT_DIGEST_CACHE.has_changed(fdata.path, old_stat_key, new_stat_key)))
+            return found
+        def _apply_content_changes(self, content_changes, change_set):
+            modified = []
+            for fdata, old_stat_key, new_stat_key, is_modified in content_changes:
+                if fdata._stat_key != old_stat_key:
+                    continue # it's been stat()ed since
+                fdata._stat_key = new_stat_key
+                if is_modified:
+                    modified.append(fdata)
+            if content_changes:
+                self._invalidate_stats()
+            if modified:
+                change_set[self.data.path] = DirChanges([], [], modified)
+        def _refresh(self, change_set):
+            # Bring this (populated) directory and those below it up to
+            # date only rescanning those that have actually changed
+            if not self._is_populated:
+                return
+            if self._is_stale():
+                self._rescan(change_set)
+            for subdir in self._subdirs.values():
+                subdir._refresh(change_set)
+        def _rescan(self, change_set, scan=None):
+            # Repopulate this (stale) directory reusing its populated
+            # subdirectories that are still present (and its scan from
+            # prepare_reset() if it's still valid)
+            old_data_list = self._subdirs_data + self._files_data
+            old_subdirs = self._subdirs
+            self._subdirs = {}
+            self._files_data = []
+            self._is_dirty = False
+            if scan is not None and scan[0] != self._get_current_change_token():
+                scan = None
+            self._change_token = self._populate(scan)
+            for name, subdir in self._subdirs.items():
+                old_subdir = old_subdirs.pop(name, None)
+                if old_subdir is not None and old_subdir._is_populated:
+                    old_subdir.data = subdir.data
+                    self._subdirs[name] = old_subdir
+                    if self._dir_index is not None:
+                        self._dir_index[_normalized_relpath(old_subdir.data.path)] = old_subdir
+            # what's left in old_subdirs has gone
+            if self._dir_monitor is not None:
+                self._dir_monitor.forget([fd for old_subdir in old_subdirs.values() for fd in old_subdir._iter_populated_dirs()])
+            if self._dir_index is not None:
+                for old_subdir in old_subdirs.values():
+                    for fd in old_subdir._iter_dirs():
+                        self._dir_index.pop(_normalized_relpath(fd.data.path), None)
+            self._record_changes(old_data_list, change_set)
+        def _populate_like(self, old_dir, change_set, catch_up=False):
+            # Populate the same directories as were populated in the
+            # (discarded) old_dir recording the differences (or, if
+            # catching up with old_dir after being built from it, only
+            # do those that have been populated in it since)
+            if not old_dir._is_populated:
+                return
+            if not self._is_populated:
+                self._change_token = self._populate()
+                self._record_changes(old_dir._subdirs_data + old_dir._files_data, change_set)
+            elif not catch_up:
+                self._record_changes(old_dir._subdirs_data + old_dir._files_data, change_set)
+            for name, old_subdir in old_dir._subdirs.items():
+                subdir = self._subdirs.get(name, None)
+                if subdir is not None:
+                    subdir._populate_like(old_subdir, change_set, catch_up)
+        def _adopt_dir_monitor(self, dir_monitor):
+            # Start change tracking for a tree that was built (in a worker
+            # thread) without a dir monitor
+            self._dir_monitor = dir_monitor
+            if self._is_populated:
+                self._start_change_tracking()
+                if self._is_watched and self._get_current_change_token() != self._change_token:
+                    dir_monitor.mark_changed(self)
+            for subdir in self._subdirs.values():
+                subdir._adopt_dir_monitor(dir_monitor)
+        def _get_ignore_rules(self):
+            # the (rules, path prefix) for each ignore file that applies
+            # to our entries (deepest first)
+            # NB: they're reloaded when we're repopulated so that's when
+            # changes to the ignore files take effect
+            if self._ignore_rules is None:
+                if self._parent is None:
+                    self._ignore_rules = []
                 else:
-                    self._add_file(name=item)
+                    self._ignore_rules = [(rules, prefix + self.data.name + "/") for rules, prefix in self._parent._get_ignore_rules()]
+                if self._has_ignore_file:
+                    rules = IgnoreRules.load(os.path.join(self.data.path, self.IGNORE_FILE_NAME))
+                    if rules:
+                        self._ignore_rules.insert(0, (rules, ""))
+            return self._ignore_rules
+        def _get_ignored_names(self, entries):
+            # NB: everything in an ignored directory is ignored
+            if self._is_ignored():
+                return {name for name, _is_dir in entries}
+            self._has_ignore_file = self.IGNORE_FILE_NAME is not None and (self.IGNORE_FILE_NAME, False) in entries
+            self._ignore_rules = None
+            rules_list = self._get_ignore_rules()
+            if not rules_list:
+                return ()
+            ignored = set()
+            for name, is_dir in entries:
+                for rules, prefix in rules_list:
+                    verdict = rules.match(prefix, name, is_dir)
+                    if verdict is not None:
+                        if verdict:
+                            ignored.add(name)
+                        break
+            return ignored
+        def _populate(self, scan=None):
+            # NB: start tracking before scanning the directory so that
+            # changes during the scan are picked up at the next check
+            self._start_change_tracking()
+            change_token, entries = scan if scan is not None else self.scan()
+            dir_path = self.data.path
+            ignored = self._get_ignored_names(entries)
+            for name, is_dir in entries:
+                status = FSTATUS_IGNORED if name in ignored else None
+                if is_dir:
+                    self._add_subdir(name=name, status=status, exists=True)
+                else:
+                    self._files_data.append(self.FILE_DATA.in_dir(dir_path, name, status))
             self._files_data.sort()
             # presort this data for multiple access efficiency
             self._subdirs_data = sorted([s.data for s in self._subdirs.values()])
+            self._views = {}
+            self._has_file_stats = False
+            if self.TRACK_CONTENT_CHANGES:
+                self._stat_files()
             self._is_populated = True
-            return h.digest()
+            self._invalidate_stats()
+            return change_token
+        @property
+        def stats(self):
+            """The DirStats for the populated part of the tree below this
+            directory (or None if this directory isn't populated)
+            """
+            if not self._is_populated:
+                return None
+            if self._stats is None:
+                self._stats = get_dir_stats(self._files_data, self._subdirs.values())
+                self._has_file_stats = True
+            return self._stats
+        def _invalidate_stats(self):
+            # NB: ancestors' stats may have been calculated while we were
+            # unpopulated so they always need to be invalidated
+            file_dir = self
+            while file_dir is not None:
+                file_dir._stats = None
+                file_dir = file_dir._parent
         def find_dir(self, dir_path):
             if not dir_path or dir_path == os.curdir:
                 return self
             if dir_path.startswith(os.curdir + os.sep):
                 dir_path = dir_path[len(os.curdir + os.sep):]
+            # NB: OsFileDb.find_dir() should be preferred as it doesn't recurse
             sep_index = dir_path.find(os.sep)
             if sep_index == -1:
-                return self._subdirs[dir_path]
-            return self._subdirs[dir_path[:sep_index]].find_dir(dir_path[sep_index + 1:])
-        def dirs_and_files(self, show_hidden=False, **kwargs):
+                return self._subdirs.get(dir_path, None)
+            subdir = self._subdirs.get(dir_path[:sep_index], None)
+            return subdir.find_dir(dir_path[sep_index + 1:]) if subdir is not None else None
+        def _filtered_dirs_and_files(self, show_hidden):
+            if show_hidden:
+                return (self._subdirs_data, self._files_data)
+            return ([x for x in self._subdirs_data if x.name[0] != "." and x.status != FSTATUS_IGNORED], [x for x in self._files_data if x.name[0] != "." and x.status != FSTATUS_IGNORED])
+        def get_view(self, show_hidden=False, **kwargs):
+            """Return the (dirs, files) lists to show in the given view
+            mode.  NB: they're shared so must not be modified.
+            """
             if not self._is_populated:
-                self._dir_hash_digest = self._populate()
+                self._change_token = self._populate()
+            # NB: the filtered lists are kept until we're repopulated so
+            # that toggling view modes doesn't refilter the whole tree
+            view = self._views.get(show_hidden, None)
+            if view is None:
+                view = self._views[show_hidden] = self._filtered_dirs_and_files(show_hidden)
+            return view
+        def dirs_and_files(self, show_hidden=False, **kwargs):
+            view = self.get_view(show_hidden=show_hidden)
             # use iterators for efficiency and data integrity
-            if show_hidden:
-                dirs = iter(self._subdirs_data)
-                files = iter(self._files_data)
-            else:
-                dirs = filter((lambda x: x.name[0] != "."), self._subdirs_data)
-                files = filter((lambda x: x.name[0] != "."), self._files_data)
-            return (dirs, files)
-    def __init__(self, **kwargs):
+            return (iter(view[0]), iter(view[1]))
+    # the changes made by the last reset() keyed by directory path (or
+    # None if they're unknown and everything should be considered changed)
+    change_set = None
+    def __init__(self, use_inotify=False, use_tree_cache=False, **kwargs):
         # NB: we don't save kwargs as it's only there to allow children
         # to pass args for initializing the base_dir
-        self.base_dir = self.FileDir(**kwargs)
+        self._dir_monitor = InotifyDirMonitor.new_if_available() if use_inotify else None
+        self._tree_cache = TreeCache.load(self._get_tree_cache_path()) if use_tree_cache else None
+        self._dir_index = {}
+        # NB: None means there's been no prepare_reset()
+        self._prepared_scans = None
+        self._prepared_content_changes = None
+        self._are_file_stats_stale = False
+        self._file_name_index = None
+        self.base_dir = self.FileDir(dir_monitor=self._dir_monitor, tree_cache=self._tree_cache, dir_index=self._dir_index, **kwargs)
     def __getattr__(self, name):
         if name == "is_current": return self._is_current()
         raise AssertionError(name)
+    def close(self):
+        """Release the operating system resources (e.g. the inotify
+        instance) held by the db.  NB: it mustn't be used afterwards.
+        """
+        if self._dir_monitor is not None:
+            self._dir_monitor.close()
     def _is_current(self):
+        if self._dir_monitor is not None:
+            return self._dir_monitor.is_current
         return self.base_dir.is_current
+    def _is_data_current(self):
+        # NB: children with data other than the file system's (e.g. from
+        # an SCM) should reimplement this to check it
+        return True
+    def prepare_reset(self):
+        """Do the expensive part of the next reset() (after is_current
+        has been found to be False) without modifying the db so that it
+        may be done in a worker thread
+        """
+        # NB: the stale directories are recorded (with a None scan if
+        # it failed) so that reset() only needs to visit them
+        scans = {}
+        for file_dir in self.base_dir._iter_populated_dirs():
+            if file_dir._is_stale():
+                try:
+                    scans[file_dir] = file_dir.scan()
+                except OSError:
+                    scans[file_dir] = None # it'll be dealt with by reset()
+        self._prepared_scans = scans
+        if self.FileDir.TRACK_CONTENT_CHANGES:
+            self._prepared_content_changes = self._find_content_changes()
+    def _take_prepared_scans(self):
+        scans, self._prepared_scans = self._prepared_scans, None
+        return scans
+    def _refresh_tree(self):
+        # Bring the populated directories up to date (in reset()) only
+        # visiting those found to be stale by the dir monitor or
+        # prepare_reset() when they're known.  Return False if the dir
+        # monitor has lost events and the tree needs to be rebuilt.
+        scans = self._take_prepared_scans()
+        if self._dir_monitor is not None:
+            if not self._dir_monitor.prepare_for_refresh():
+                return False
+            stale_dirs = self._dir_monitor.take_stale_dirs()
+            if scans:
+                stale_dirs.update(scans)
+        elif scans is not None:
+            stale_dirs = scans
+        else:
+            self.base_dir._refresh(self.change_set)
+            return True
+        # NB: parents before their children so that those dropped with
+        # their parent are skipped (and their tokens are rechecked as
+        # they may have been refreshed since)
+        for file_dir in sorted(stale_dirs, key=lambda file_dir: file_dir.data.path.count(os.sep)):
+            if file_dir._is_populated and self.find_dir(file_dir.data.path) is file_dir and file_dir._is_stale():
+                file_dir._rescan(self.change_set, scans.get(file_dir, None) if scans else None)
+        return True
+    def _find_content_changes(self):
+        # NB: this doesn't modify the db so it may be run in a worker thread
+        content_changes = []
+        for file_dir in self.base_dir._iter_populated_dirs():
+            files_data = file_dir._files_data
+            changes = file_dir._find_content_changes()
+            if changes:
+                content_changes.append((file_dir, files_data, changes))
+        return content_changes
+    def _update_file_stats(self):
+        # NB: a file's size (and contents) can change without its
+        # directory's change token doing so
+        content_changes, self._prepared_content_changes = self._prepared_content_changes, None
+        if not self.FileDir.TRACK_CONTENT_CHANGES:
+            # the sizes are rechecked when the stats are next wanted
+            # rather than by every reset()
+            self._are_file_stats_stale = True
+            return
+        if content_changes is None:
+            content_changes = self._find_content_changes()
+        for file_dir, files_data, changes in content_changes:
+            # NB: skip those that have been rescanned (or dropped) since
+            if file_dir._files_data is files_data and self.find_dir(file_dir.data.path) is file_dir:
+                file_dir._apply_content_changes(changes, self.change_set)
+    def _refresh_file_stats(self):
+        self._are_file_stats_stale = False
+        for file_dir in self.base_dir._iter_populated_dirs():
+            # NB: only those whose stats have been asked for matter
+            if file_dir._has_file_stats and [fdata for fdata in file_dir._files_data if fdata.refresh_stat()]:
+                file_dir._invalidate_stats()
     def reset(self):
         # NB: should be reimpleted by children who shouldn't call this version
-        self.base_dir = self.FileDir()
+        self.change_set = {}
+        if self._refresh_tree():
+            self._update_file_stats()
+        else:
+            self._prepared_content_changes = None
+            self._dir_monitor.reset()
+            old_base_dir = self.base_dir
+            self._dir_index = {}
+            self.base_dir = self.FileDir(dir_monitor=self._dir_monitor, tree_cache=self._tree_cache, dir_index=self._dir_index)
+            self.base_dir._populate_like(old_base_dir, self.change_set)
+        self._update_file_name_index()
         return self
+    def _index_files_in(self, file_dir):
+        for a_file_dir in file_dir._iter_all_dirs():
+            dir_path = a_file_dir.data.path
+            for fdata in a_file_dir._files_data:
+                if not a_file_dir._is_hidden_file(fdata):
+                    self._file_name_index.add_file(dir_path, fdata.name)
+    def get_file_name_index(self):
+        """Return a FileNameIndex of all the files in the db that aren't
+        hidden or ignored (which entails populating the tree below the
+        visible directories the first time it's called).
+        It's kept up to date by reset() using the change set.
+        """
+        if self._file_name_index is None:
+            self._file_name_index = FileNameIndex()
+            self._index_files_in(self.base_dir)
+        return self._file_name_index
+    def _update_file_name_index(self):
+        if self._file_name_index is None:
+            return
+        for dir_path, changes in self.change_set.items():
+            parent_dir = self.find_dir(dir_path)
+            is_indexed = parent_dir is not None and parent_dir._is_indexed()
+            for data in changes.removed:
+                if data.is_dir:
+                    self._file_name_index.remove_dir(data.path)
+                else:
+                    self._file_name_index.remove_file(dir_path, data.name)
+            # NB: "modified" covers an entry changing between file and dir
+            # (or becoming hidden or ignored)
+            for data in changes.added + changes.modified:
+                if data.is_dir:
+                    self._file_name_index.remove_file(dir_path, data.name)
+                    file_dir = self.find_dir(data.path)
+                    if not is_indexed or file_dir is None or file_dir._is_ignored() or parent_dir._is_hidden_dir(data):
+                        self._file_name_index.remove_dir(data.path)
+                    elif not file_dir._is_populated:
+                        self._index_files_in(file_dir)
+                else:
+                    # NB: it may have been a directory (with subdirectories)
+                    self._file_name_index.remove_dir(data.path)
+                    if is_indexed and not parent_dir._is_hidden_file(data):
+                        self._file_name_index.add_file(dir_path, data.name)
+                    else:
+                        self._file_name_index.remove_file(dir_path, data.name)
+    def find_file_paths(self, query, max_results=20):
+        """Return the paths of the files in the db that best match "query"
+        (best first)
+        """
+        return self.get_file_name_index().search(query, max_results)
+    def find_dir(self, dir_path):
+        """Return the FileDir for "dir_path" (or None if it isn't in the db)"""
+        return self._dir_index.get(_normalized_relpath(dir_path), None)
+    def get_dir_stats(self, dir_path=""):
+        """Return the DirStats for "dir_path" (or None if unknown)"""
+        tdir = self.find_dir(dir_path)
+        if not tdir:
+            return None
+        if self._are_file_stats_stale:
+            self._refresh_file_stats()
+        return tdir.stats
     def dir_contents(self, dir_path="", show_hidden=False, **kwargs):
-        tdir = self.base_dir.find_dir(dir_path)
+        tdir = self.find_dir(dir_path)
         if not tdir:
             return ([], [])
         return tdir.dirs_and_files(show_hidden=show_hidden, **kwargs)
+    def get_dir_view(self, dir_path="", show_hidden=False, **kwargs):
+        """Return the (dirs, files) lists for "dir_path" that dir_contents()
+        would iterate over (for models that serve rows straight from the
+        db).  NB: they're shared with the db so must not be modified and
+        a directory's lists are only replaced when it changes.
+        """
+        tdir = self.find_dir(dir_path)
+        if not tdir:
+            return ([], [])
+        return tdir.get_view(show_hidden=show_hidden, **kwargs)
+    @staticmethod
+    def _get_tree_cache_path():
+        return TreeCache.get_path_for_dir(os.getcwd())
+    def save_tree_cache(self):
+        TreeCache.save(self._get_tree_cache_path(), self.base_dir._iter_populated_dirs())
+    def get_unpopulated_subdirs(self, dir_path="", **kwargs):
+        """Return the visible (and not ignored) subdirectories of the
+        (populated) directory at "dir_path" that haven't been populated
+        yet (candidates for populating in the background via their scan()
+        and install_scan() methods)
+        """
+        tdir = self.find_dir(dir_path)
+        if not tdir or not tdir._is_populated:
+            return []
+        dirs, _files = tdir.dirs_and_files(**kwargs)
+        subdirs = (tdir._subdirs[ddata.name] for ddata in dirs)
+        return [subdir for subdir in subdirs if not subdir._is_populated and not subdir._is_ignored()]
+
+class CurrencyChecker:
+    """Check whether a file db is current a bit at a time (resuming
+    where the last check left off) so that no single check stalls the
+    main loop however big the populated tree is.
+    """
+    def __init__(self, file_db):
+        self.file_db = file_db
+        self._stack = None
+        self._priority_stack = None
+        self._checked = None
+    def restart(self):
+        self._stack = None
+        self._priority_stack = None
+        self._checked = None
+    def check(self, max_dirs=None, max_msecs=None, priority_dir_paths=()):
+        """Check (at most) "max_dirs" populated directories or for
+        "max_msecs" milliseconds starting with the base directory and
+        then those in "priority_dir_paths" (e.g. those expanded in a
+        view).  Return False if a change has been found, True if a
+        complete pass has found none and None if the pass isn't
+        complete yet.  NB: "priority_dir_paths" is only looked at when
+        a new pass starts.
+        """
+        if not isinstance(self.file_db, OsFileDb) or self.file_db._dir_monitor is not None:
+            # nothing to be gained by spreading the check out
+            return self.file_db.is_current
+        deadline = None if max_msecs is None else time.monotonic() + max_msecs / 1000.0
+        if self._stack is None:
+            if not self.file_db._is_data_current():
+                return False
+            # NB: the stacks' tops are at their ends and the priority
+            # paths are looked up as they're reached (within the budget)
+            self._priority_stack = [""]
+            self._priority_stack.extend(priority_dir_paths)
+            self._priority_stack.reverse()
+            self._stack = [self.file_db.base_dir]
+            self._checked = set()
+        # NB: those skipped (e.g. already checked as priorities) count
+        # towards the budget too so that there's no unbounded loop
+        n_visited = 0
+        while self._priority_stack or self._stack:
+            if (max_dirs is not None and n_visited >= max_dirs) or (deadline is not None and time.monotonic() >= deadline):
+                break
+            n_visited += 1
+            if self._priority_stack:
+                file_dir = self.file_db.find_dir(self._priority_stack.pop())
+                if file_dir is None or not file_dir._is_populated:
+                    continue
+            else:
+                file_dir = self._stack.pop()
+                # NB: even if it's been checked as a priority
+                self._stack.extend(subdir for subdir in file_dir._subdirs.values() if subdir._is_populated)
+            if file_dir in self._checked:
+                continue
+            self._checked.add(file_dir)
+            if file_dir._is_stale():
+                self.restart()
+                return False
+        if self._priority_stack or self._stack:
+            return None
+        self.restart()
+        return True
+
+def _normalized_relpath(file_path):
+    # NB: os.path.relpath() is only needed (and only paid for) with absolute paths
+    return os.path.relpath(file_path) if os.path.isabs(file_path) else os.path.normpath(file_path)
+
+_EMPTY_BUCKET = ((), frozenset())
 
 class Snapshot:
-    def __init__(self, file_status_data, relevant_keys=None):
+    # NB: the keys are held in an index sorted by normalized relative path
+    # (with those outside the current directory at the end) so that the
+    # snapshot for a subdirectory is just a range within its parent's and
+    # narrowing shares the index rather than copying it
+    # NB: children that know (from the SCM's output) which keys are
+    # directories should supply them as dir_keys to avoid a stat() per key
+    def __init__(self, file_status_data, relevant_keys=None, dir_keys=None):
         self._file_status_data = file_status_data
-        self._relevant_keys = file_status_data.keys() if relevant_keys is None else relevant_keys
-        self._status_set = frozenset(file_status_data[key][0] for key in self._relevant_keys)
+        relevant_keys = file_status_data.keys() if relevant_keys is None else relevant_keys
+        self._dir_keys = frozenset(key for key in relevant_keys if os.path.isdir(key)) if dir_keys is None else frozenset(dir_keys)
+        index = sorted((self._outside_curdir(norm_path), norm_path, key) for key, norm_path in ((key, _normalized_relpath(key)) for key in relevant_keys))
+        self._norm_paths = [item[1] for item in index]
+        self._keys = [item[2] for item in index]
+        self._lo = 0
+        self._hi = len(index)
+        # NB: the number of keys within the current directory
+        self._n_inside = sum(1 for item in index if not item[0])
+        self._status_set = None
+        self._dir_path = os.curdir
+        self._own_keys = ()
+        self._dir_buckets = self._make_dir_buckets(self._norm_paths[:self._n_inside], self._keys[:self._n_inside], self._dir_keys)
+    @staticmethod
+    def _outside_curdir(norm_path):
+        return norm_path == os.pardir or norm_path.startswith(os.pardir + os.sep)
+    @staticmethod
+    def _make_dir_buckets(norm_paths, keys, dir_keys):
+        # Map each directory to the (name, key) of the files directly within
+        # it and the names of its immediate subdirectories that contain files
+        buckets = {}
+        for norm_path, key in zip(norm_paths, keys):
+            if key in dir_keys:
+                continue
+            dir_path, name = os.path.split(norm_path)
+            dir_path = dir_path if dir_path else os.curdir
+            try:
+                buckets[dir_path][0].append((name, key))
+            except KeyError:
+                buckets[dir_path] = ([(name, key)], set())
+            while dir_path != os.curdir:
+                parent_dir_path, name = os.path.split(dir_path)
+                parent_dir_path = parent_dir_path if parent_dir_path else os.curdir
+                try:
+                    subdir_names = buckets[parent_dir_path][1]
+                except KeyError:
+                    subdir_names = set()
+                    buckets[parent_dir_path] = ([], subdir_names)
+                if name in subdir_names:
+                    break # so are all of its ancestors
+                subdir_names.add(name)
+                dir_path = parent_dir_path
+        return buckets
     @property
     def status_set(self):
+        if self._status_set is None:
+            keys = itertools.chain(self._own_keys, self._keys[self._lo:self._hi])
+            self._status_set = frozenset(self._file_status_data[key][0] for key in keys)
         return self._status_set
     def __iter__(self):
-        for file_path in self._relevant_keys:
-            if os.path.isdir(file_path):
-                continue # TODO: move this to git specific code
+        for file_path in self._keys[self._lo:self._hi]:
+            if file_path in self._dir_keys:
+                continue
             status, related_file_data = self._file_status_data[file_path]
             yield (file_path, status, related_file_data)
-        raise StopIteration
+    @property
+    def subdir_names(self):
+        """The names of the subdirectories (of the directory that this
+        snapshot has been narrowed for) that contain files of interest
+        """
+        return self._dir_buckets.get(self._dir_path, _EMPTY_BUCKET)[1]
+    def iter_dir_files(self):
+        """Iterate over the (name, file_path, status, related_file_data)
+        of the files directly within the directory that this snapshot
+        has been narrowed for
+        """
+        for name, file_path in self._dir_buckets.get(self._dir_path, _EMPTY_BUCKET)[0]:
+            status, related_file_data = self._file_status_data[file_path]
+            yield (name, file_path, status, related_file_data)
     def narrowed_for_subdir(self, dir_path):
-        relevant_keys = [file_path for file_path in self._relevant_keys if file_path_belongs_here(file_path, dir_path)]
-        return self.__class__(self._file_status_data, relevant_keys)
+        norm_dir_path = _normalized_relpath(dir_path) if dir_path else os.curdir
+        lo, hi = self._lo, min(self._hi, self._n_inside)
+        own_keys = ()
+        if norm_dir_path != os.curdir:
+            # NB: a key for the directory itself (e.g. an untracked one)
+            # counts towards its status but isn't one of its files
+            own_lo = bisect.bisect_left(self._norm_paths, norm_dir_path, lo, hi)
+            own_hi = bisect.bisect_right(self._norm_paths, norm_dir_path, own_lo, hi)
+            own_keys = self._keys[own_lo:own_hi]
+            # all keys starting with "<norm_dir_path>/" are contiguous
+            lo = bisect.bisect_left(self._norm_paths, norm_dir_path + os.sep, own_hi, hi)
+            hi = bisect.bisect_left(self._norm_paths, norm_dir_path + chr(ord(os.sep) + 1), lo, hi)
+        narrowed = copy.copy(self)
+        narrowed._lo, narrowed._hi = lo, hi
+        narrowed._own_keys = own_keys
+        narrowed._status_set = None
+        narrowed._dir_path = norm_dir_path
+        return narrowed
 
 class GenericSnapshotWsFileDb(OsFileDb):
     class FileDir(OsFileDb.FileDir):
@@ -212,19 +1571,22 @@ class GenericSnapshotWsFileDb(OsFileDb):
         DEFAULT_DIR_STATUS = None
         DIR_DATA = None
         FILE_DATA = None
-        def __init__(self, name=None, dir_path=None, status=False, clean_status=False, parent_file_status_snapshot=None):
+        def __init__(self, name=None, dir_path=None, status=False, clean_status=False, parent_file_status_snapshot=None, exists=False, dir_monitor=None, tree_cache=None, dir_index=None, parent=None):
             self._file_status_snapshot = parent_file_status_snapshot.narrowed_for_subdir(dir_path)
-            self._exists = os.path.isdir(dir_path if dir_path else os.curdir)
-            OsFileDb.FileDir.__init__(self, name, dir_path, status=status, clean_status=clean_status)
+            # NB: "exists" is True if our parent has just seen us in its scan
+            self._exists = exists or os.path.isdir(dir_path if dir_path else os.curdir)
+            OsFileDb.FileDir.__init__(self, name, dir_path, status=status, clean_status=clean_status, dir_monitor=dir_monitor, tree_cache=tree_cache, dir_index=dir_index, parent=parent)
         def _is_current(self):
             if not self._is_populated:
                 return self._get_current_status() == self.data.status
-            if self._get_current_hash_digest() != self._dir_hash_digest:
+            if self._get_current_change_token() != self._change_token:
                 return False
             for subdir in self._subdirs.values():
                 if not subdir.is_current:
                     return False
             return True
+        def _is_ignored(self):
+            return self.data.status in self.IGNORED_STATUS_SET
         def _get_initial_status(self, dir_path):
             return self.DEFAULT_DIR_STATUS
         def _get_initial_clean_status(self, dir_path):
@@ -237,35 +1599,27 @@ class GenericSnapshotWsFileDb(OsFileDb):
         def _add_subdir(self, name, dir_path=None, status=False, clean_status=False, **kwargs):
             if not dir_path:
                 dir_path = os.path.join(self.data.path, name)
-            self._subdirs[name] = self._new_dir(name=name, dir_path=dir_path, status=status, clean_status=clean_status, parent_file_status_snapshot=self._file_status_snapshot, **kwargs)
-        def _get_current_hash_digest(self):
-            h = hashlib.sha1()
-            for item in os.listdir(self.data.path):
-                h.update(item.encode())
-            return h.digest()
-        def _populate(self):
-            h = hashlib.sha1()
+            self._subdirs[name] = self._new_dir(name=name, dir_path=dir_path, status=status, clean_status=clean_status, parent_file_status_snapshot=self._file_status_snapshot, dir_monitor=self._dir_monitor, tree_cache=self._tree_cache, dir_index=self._dir_index, parent=self, **kwargs)
+        def _populate(self, scan=None):
+            self._start_change_tracking()
+            change_token = None
             try:
+                change_token, entries = scan if scan is not None else self.scan()
                 files_dict = {}
-                for item in os.listdir(self.data.path):
-                    h.update(item.encode())
-                    dir_path = os.path.join(self.data.path, item)
-                    if os.path.isdir(dir_path):
-                        self._add_subdir(name=item, dir_path=dir_path)
-                    else:
-                        files_dict[item] = self.FILE_DATA(path=os.path.join(self.data.path, item), status=self.DEFAULT_FILE_STATUS, related_file_data=None)
-                for file_path, status, rfd in iter(self._file_status_snapshot):
-                    subdir, name = os.path.split(os.path.relpath(file_path, self.data.path))
-                    if subdir:
-                        while subdir:
-                            base_subdir = subdir
-                            subdir = os.path.dirname(subdir)
-                        if base_subdir not in self._subdirs:
-                            self._add_subdir(name=base_subdir, status=False, clean_status=False)
+                dir_path = self.data.path
+                for name, is_dir in entries:
+                    if is_dir:
+                        self._add_subdir(name=name, exists=True)
                     else:
-                        if rfd:
-                            rfd = RFD(path=os.path.relpath(rfd.path, self.data.path), relation=rfd.relation)
-                        files_dict[name] = self.FILE_DATA(path=os.path.join(self.data.path, name), status=status, related_file_data=rfd)
+                        files_dict[name] = self.FILE_DATA.in_dir(dir_path, name, status=self.DEFAULT_FILE_STATUS, related_file_data=None)
+                # NB: the snapshot has been pre sorted into per directory buckets
+                for subdir_name in self._file_status_snapshot.subdir_names:
+                    if subdir_name not in self._subdirs:
+                        self._add_subdir(name=subdir_name, status=False, clean_status=False)
+                for name, file_path, status, rfd in self._file_status_snapshot.iter_dir_files():
+                    if rfd:
+                        rfd = RFD(path=os.path.relpath(rfd.path, dir_path), relation=rfd.relation)
+                    files_dict[name] = self.FILE_DATA.in_dir(dir_path, name, status=status, related_file_data=rfd)
                 # presort this data for multiple access efficiency
                 self._files_data = sorted(files_dict.values())
                 self._subdirs_data = sorted([s.data for s in self._subdirs.values()])
@@ -273,8 +1627,13 @@ class GenericSnapshotWsFileDb(OsFileDb):
                 # handle deleted directory race condition
                 self._files_data = []
                 self._subdirs_data = []
+            self._views = {}
+            self._has_file_stats = False
+            if self.TRACK_CONTENT_CHANGES:
+                self._stat_files()
             self._is_populated = True
-            return h.digest()
+            self._invalidate_stats()
+            return change_token
         def _is_hidden_dir(self, ddata):
             if ddata.name[0] == ".":
                 return ddata.status not in self.SIGNIFICANT_DATA_SET and ddata.clean_status not in self.SIGNIFICANT_DATA_SET
@@ -287,35 +1646,67 @@ class GenericSnapshotWsFileDb(OsFileDb):
             return ddata.status in self.CLEAN_STATUS_SET and ddata.clean_status not in self.SIGNIFICANT_DATA_SET
         def _is_clean_file(self, fdata):
             return fdata.status in self.CLEAN_STATUS_SET
-        def dirs_and_files(self, show_hidden=False, hide_clean=False):
-            if not self._is_populated:
-                self._dir_hash_digest = self._populate()
+        def _filtered_dirs_and_files(self, show_hidden, hide_clean):
             if show_hidden:
                 if hide_clean:
-                    dirs = filter((lambda x: x.status not in self.CLEAN_STATUS_SET or x.clean_status in self.SIGNIFICANT_DATA_SET), self._subdirs_data)
-                    files = filter((lambda x: x.status not in self.CLEAN_STATUS_SET), self._files_data)
+                    dirs = [x for x in self._subdirs_data if x.status not in self.CLEAN_STATUS_SET or x.clean_status in self.SIGNIFICANT_DATA_SET]
+                    files = [x for x in self._files_data if x.status not in self.CLEAN_STATUS_SET]
                 else:
-                    dirs = iter(self._subdirs_data)
-                    files = iter(self._files_data)
+                    dirs = self._subdirs_data
+                    files = self._files_data
             elif hide_clean:
-                dirs = filter((lambda x: not ((x.status in self.CLEAN_STATUS_SET and x.clean_status not in self.SIGNIFICANT_DATA_SET) or self._is_hidden_dir(x))), self._subdirs_data)
-                files = filter((lambda x: not (x.status in self.CLEAN_STATUS_SET or self._is_hidden_file(x))), self._files_data)
+                dirs = [x for x in self._subdirs_data if not ((x.status in self.CLEAN_STATUS_SET and x.clean_status not in self.SIGNIFICANT_DATA_SET) or self._is_hidden_dir(x))]
+                files = [x for x in self._files_data if not (x.status in self.CLEAN_STATUS_SET or self._is_hidden_file(x))]
             else:
-                dirs = filter((lambda x: not self._is_hidden_dir(x)), self._subdirs_data)
-                files = filter((lambda x: not self._is_hidden_file(x)), self._files_data)
+                dirs = [x for x in self._subdirs_data if not self._is_hidden_dir(x)]
+                files = [x for x in self._files_data if not self._is_hidden_file(x)]
             return (dirs, files)
-    def __init__(self, **kwargs):
+        def get_view(self, show_hidden=False, hide_clean=False):
+            if not self._is_populated:
+                self._change_token = self._populate()
+            key = (show_hidden, hide_clean)
+            view = self._views.get(key, None)
+            if view is None:
+                view = self._views[key] = self._filtered_dirs_and_files(show_hidden, hide_clean)
+            return view
+        def dirs_and_files(self, show_hidden=False, hide_clean=False):
+            view = self.get_view(show_hidden=show_hidden, hide_clean=hide_clean)
+            return (iter(view[0]), iter(view[1]))
+    def __init__(self, use_inotify=False, use_tree_cache=False, **kwargs):
         # save the args for use in reset and related attribute mechanism
-        self._kwargs = kwargs
+        # NB: including the OsFileDb options so that they survive a rebuild
+        self._kwargs = dict(kwargs, use_inotify=use_inotify, use_tree_cache=use_tree_cache)
+        # NB: get the change token first so that changes during the fetch aren't missed
+        self._db_change_token = self._current_change_token = self._get_change_token()
         h = hashlib.sha1()
-        self._file_status_snapshot = self._extract_file_status_snapshot(self._get_file_data_text(h))
+        self._file_status_snapshot = self._extract_file_status_snapshot(self._get_file_data(h))
         self._db_digest = h.digest()
         self._current_text_digest = None
-        OsFileDb.__init__(self, parent_file_status_snapshot=self._file_status_snapshot)
+        self._prepared_rebuild = None
+        OsFileDb.__init__(self, use_inotify=use_inotify, use_tree_cache=use_tree_cache, parent_file_status_snapshot=self._file_status_snapshot)
     # NB the fetching of data is done in two steps to allow efficient "is_current" computation
+    # Children may supply a cheap token (e.g. the stat() of the SCM's index
+    # file) that changes whenever the file data may have so that it's only
+    # refetched when necessary.  None means "unknown" (always refetch).
+    def _get_change_token(self):
+        return None
+    def _get_file_data(self, h):
+        chunks = self._get_file_data_chunks()
+        if chunks is None:
+            return self._get_file_data_text(h)
+        return self._extract_file_data_from_records(iter_nul_records(chunks, h))
     def _get_file_data_text(self, h):
         assert False, "_get_file_data_text() must be defined in child"
-    def _extract_file_status_snapshot(self, file_data_text):
+    # Children whose SCM can output NUL separated records (e.g. "git status
+    # -z") may instead stream it by returning an iterator over its bytes
+    # (e.g. iter_chunks(pipe)) from _get_file_data_chunks() and parsing the
+    # (bytes) records in _extract_file_data_from_records() as they
+    # arrive.  Its result is then what's passed to _extract_file_status_snapshot().
+    def _get_file_data_chunks(self):
+        return None
+    def _extract_file_data_from_records(self, records):
+        assert False, "_extract_file_data_from_records() must be defined in child if streaming"
+    def _extract_file_status_snapshot(self, file_data):
         assert False, "_extract_file_status_snapshot() must be defined in child"
     def __getattr__(self, name):
         if name == "is_current": return self._is_current()
@@ -326,18 +1717,73 @@ class GenericSnapshotWsFileDb(OsFileDb):
         except KeyError:
             pass
         raise AttributeError(name)
-    def _is_current(self):
+    def _is_data_current(self):
+        self._current_change_token = self._get_change_token()
+        if self._current_change_token is not None and self._current_change_token == self._db_change_token:
+            # NB: the file data is unchanged so there's no need to fetch it
+            self._current_text_digest = self._db_digest
+            return True
         h = hashlib.sha1()
-        self._current_text = self._get_file_data_text(h)
+        self._current_text = self._get_file_data(h)
         self._current_text_digest = h.digest()
-        return self._current_text_digest == self._db_digest and self.base_dir.is_current
+        if self._current_text_digest == self._db_digest:
+            # the token changed but the data didn't
+            self._db_change_token = self._current_change_token
+            return True
+        return False
+    def _is_current(self):
+        return self._is_data_current() and OsFileDb._is_current(self)
+    def prepare_reset(self):
+        if self._current_text_digest is not None and self._current_text_digest != self._db_digest:
+            # The SCM data has changed so build the whole new tree (and
+            # find the changes) here leaving reset() to just swap it in.
+            # NB: it has no dir monitor as that's not thread safe
+            snapshot = self._extract_file_status_snapshot(self._current_text)
+            dir_index = {}
+            base_dir = self.FileDir(parent_file_status_snapshot=snapshot, tree_cache=self._tree_cache, dir_index=dir_index)
+            change_set = {}
+            base_dir._populate_like(self.base_dir, change_set)
+            self._prepared_rebuild = (self._current_text_digest, snapshot, base_dir, dir_index, change_set)
+        else:
+            OsFileDb.prepare_reset(self)
     def reset(self):
         if self._current_text_digest is None:
+            self.close()
             return self.__class__(**self._kwargs)
-        if self._current_text_digest != self._db_digest:
+        self.change_set = {}
+        prepared, self._prepared_rebuild = self._prepared_rebuild, None
+        if self._current_text_digest == self._db_digest:
+            # only the file system has changed so reuse what we can
+            if self._refresh_tree():
+                self._update_file_stats()
+                self._update_file_name_index()
+                return self
+        else:
+            # NB: anything prepared for the old tree is now irrelevant
+            self._take_prepared_scans()
+            self._prepared_content_changes = None
+            if prepared is not None and prepared[0] == self._current_text_digest:
+                _digest, self._file_status_snapshot, base_dir, self._dir_index, self.change_set = prepared
+                self._db_digest = self._current_text_digest
+                self._db_change_token = self._current_change_token
+                old_base_dir, self.base_dir = self.base_dir, base_dir
+                # NB: directories may have been populated since it was built
+                self.base_dir._populate_like(old_base_dir, self.change_set, catch_up=True)
+                if self._dir_monitor is not None:
+                    self._dir_monitor.reset()
+                    self.base_dir._adopt_dir_monitor(self._dir_monitor)
+                self._update_file_name_index()
+                return self
             self._file_status_snapshot = self._extract_file_status_snapshot(self._current_text)
             self._db_digest = self._current_text_digest
-        self.base_dir = self.FileDir(parent_file_status_snapshot=self._file_status_snapshot)
+            self._db_change_token = self._current_change_token
+        if self._dir_monitor is not None:
+            self._dir_monitor.reset()
+        old_base_dir = self.base_dir
+        self._dir_index = {}
+        self.base_dir = self.FileDir(parent_file_status_snapshot=self._file_status_snapshot, dir_monitor=self._dir_monitor, tree_cache=self._tree_cache, dir_index=self._dir_index)
+        self.base_dir._populate_like(old_base_dir, self.change_set)
+        self._update_file_name_index()
         return self
 
 class GenericChangeFileDb:
@@ -350,6 +1796,8 @@ class GenericChangeFileDb:
             self._subdirs_data = []
             self._files_data = []
             self._status_set = set()
+            self._views = {}
+            self._stats = None
             self.data = self.DIR_DATA(path, None, None, None)
         @classmethod
         def _new_dir(cls, path, **kwargs):
@@ -363,43 +1811,109 @@ class GenericChangeFileDb:
                 subdir.finalize()
             # Do this last to make sure child data is up to date
             self._subdirs_data = sorted([s.data for s in self._subdirs.values()])
+            self._views = {}
+            self._stats = None
+        @property
+        def stats(self):
+            """The DirStats for the tree below this directory"""
+            # NB: calculated on demand (rather than in finalize()) as
+            # getting the sizes of the files costs a stat() each
+            if self._stats is None:
+                self._stats = get_dir_stats(self._files_data, self._subdirs.values())
+            return self._stats
         def add_file(self, path_parts, status, related_file_data=None):
             self._status_set.add(status)
             name = path_parts[0]
             if len(path_parts) == 1:
-                self._files_data.append(self.FILE_DATA(path=os.path.join(self.data.path, name), status=status, related_file_data=related_file_data))
+                self._files_data.append(self.FILE_DATA.in_dir(self.data.path, name, status=status, related_file_data=related_file_data))
             else:
                 if name not in self._subdirs:
                     self._subdirs[name] = self._new_dir(os.path.join(self.data.path, name))
                 self._subdirs[name].add_file(path_parts[1:], status, related_file_data)
+        def add_files(self, file_data_iter):
+            """Add the (file_path, status, related_file_data) items in
+            "file_data_iter" (paths relative to this directory) in a single
+            linear pass rather than descending the tree for each file
+            """
+            # NB: directories are found (or created) by their path relative
+            # to us (and the paths sorted so that each directory's files are
+            # added together) so each directory is only descended to once
+            file_dirs = {"": (self, self.data.path)}
+            def get_dir(dir_relpath):
+                item = file_dirs.get(dir_relpath, None)
+                if item is None:
+                    parent_relpath, name = os.path.split(dir_relpath)
+                    parent, parent_path = get_dir(parent_relpath)
+                    dir_path = os.path.join(parent_path, name)
+                    file_dir = parent._subdirs.get(name, None)
+                    if file_dir is None:
+                        file_dir = parent._subdirs[name] = parent._new_dir(dir_path)
+                    item = file_dirs[dir_relpath] = (file_dir, dir_path)
+                return item
+            items = sorted(((os.path.split(os.path.relpath(file_path) if os.path.isabs(file_path) else file_path), status, rfd) for file_path, status, rfd in file_data_iter), key=lambda item: item[0])
+            last_dir_relpath = None
+            for (dir_relpath, name), status, related_file_data in items:
+                if dir_relpath != last_dir_relpath:
+                    file_dir, dir_path = get_dir(dir_relpath)
+                    last_dir_relpath = dir_relpath
+                file_dir._status_set.add(status)
+                file_dir._files_data.append(file_dir.FILE_DATA.in_dir(dir_path, name, status=status, related_file_data=related_file_data))
+            # a directory's status set includes those of all its descendants
+            # so pass them up the tree (a path is longer than its parent's)
+            for dir_relpath in sorted(file_dirs, key=len, reverse=True):
+                if dir_relpath:
+                    file_dirs[os.path.split(dir_relpath)[0]][0]._status_set.update(file_dirs[dir_relpath][0]._status_set)
         def _calculate_status(self):
             assert False, "_calculate_status() must be defined in child"
         def _calculate_clean_status(self):
             assert False, "_calculate_clean_status() must be defined in child"
+        def _iter_dirs(self):
+            yield self
+            for subdir in self._subdirs.values():
+                yield from subdir._iter_dirs()
         def find_dir(self, dir_path):
             if not dir_path or dir_path == os.curdir:
                 return self
             if dir_path.startswith(os.curdir + os.sep):
                 dir_path = dir_path[len(os.curdir + os.sep):]
+            # NB: GenericChangeFileDb.find_dir() should be preferred as it doesn't recurse
             sep_index = dir_path.find(os.sep)
             if sep_index == -1:
-                return self._subdirs[dir_path]
-            return self._subdirs[dir_path[:sep_index]].find_dir(dir_path[sep_index + 1:])
-        def dirs_and_files(self, hide_clean=False, **kwargs):
+                return self._subdirs.get(dir_path, None)
+            subdir = self._subdirs.get(dir_path[:sep_index], None)
+            return subdir.find_dir(dir_path[sep_index + 1:]) if subdir is not None else None
+        def record_changes_since(self, old_dir, change_set):
+            changes = get_dir_changes(old_dir._subdirs_data + old_dir._files_data, self._subdirs_data + self._files_data)
+            if changes is not None:
+                change_set[self.data.path] = changes
+            for name, old_subdir in old_dir._subdirs.items():
+                subdir = self._subdirs.get(name, None)
+                if subdir is not None:
+                    subdir.record_changes_since(old_subdir, change_set)
+        def _filtered_dirs_and_files(self, hide_clean):
             if hide_clean:
-                dirs = filter((lambda x: x.status not in self.CLEAN_STATUS_SET), self._subdirs_data)
-                files = filter((lambda x: x.status not in self.CLEAN_STATUS_SET), self._files_data)
-            else:
-                dirs = iter(self._subdirs_data)
-                files = iter(self._files_data)
-            return (dirs, files)
+                return ([x for x in self._subdirs_data if x.status not in self.CLEAN_STATUS_SET], [x for x in self._files_data if x.status not in self.CLEAN_STATUS_SET])
+            return (self._subdirs_data, self._files_data)
+        def get_view(self, hide_clean=False, **kwargs):
+            view = self._views.get(hide_clean, None)
+            if view is None:
+                view = self._views[hide_clean] = self._filtered_dirs_and_files(hide_clean)
+            return view
+        def dirs_and_files(self, hide_clean=False, **kwargs):
+            view = self.get_view(hide_clean=hide_clean)
+            return (iter(view[0]), iter(view[1]))
+    change_set = None
     def __init__(self, **kwargs):
         # save the args for use in reset and related attribute mechanism
         self._kwargs = kwargs
+        # NB: get the change token first so that changes during the fetch aren't missed
+        self._db_change_token = self._current_change_token = self._get_change_token()
         h = hashlib.sha1()
-        pdt = self._get_patch_data_text(h)
+        pdt = self._get_patch_data(h)
         self._db_hash_digest = h.digest()
         self._current_text_digest = None
+        self._prepared_tree = None
+        self._file_name_index = None
         self._finalize(pdt)
     def __getattr__(self, name):
         if name == "is_current":
@@ -411,33 +1925,105 @@ class GenericChangeFileDb:
         except KeyError:
             pass
         raise AttributeError(name)
+    def _build_tree(self, pdt):
+        base_dir = self.FileDir()
+        base_dir.add_files(self._iterate_file_data(pdt))
+        base_dir.finalize()
+        # NB: the tree is complete so index it in one pass
+        return (base_dir, {_normalized_relpath(file_dir.data.path): file_dir for file_dir in base_dir._iter_dirs()})
     def _finalize(self, pdt):
-        self._base_dir = self.FileDir()
-        for file_path, status, related_file_data in self._iterate_file_data(pdt):
-            self._base_dir.add_file(split_path(file_path), status, related_file_data)
-        self._base_dir.finalize()
+        self._base_dir, self._dir_index = self._build_tree(pdt)
     def _is_current(self):
+        self._current_change_token = self._get_change_token()
+        if self._current_change_token is not None and self._current_change_token == self._db_change_token:
+            # NB: the patch data is unchanged so there's no need to fetch it
+            self._current_text_digest = self._db_hash_digest
+            return True
         h = hashlib.sha1()
-        self._current_text = self._get_patch_data_text(h)
+        self._current_text = self._get_patch_data(h)
         self._current_text_digest = h.digest()
-        return self._current_text_digest == self._db_hash_digest
+        if self._current_text_digest == self._db_hash_digest:
+            # the token changed but the data didn't
+            self._db_change_token = self._current_change_token
+            return True
+        return False
+    def prepare_reset(self):
+        """Build the new tree (if the data has changed) for the next
+        reset() without modifying the db so it may be done in a worker
+        thread
+        """
+        if self._current_text_digest is not None and self._current_text_digest != self._db_hash_digest:
+            self._prepared_tree = (self._current_text_digest, self._build_tree(self._current_text))
     def reset(self):
         if self._current_text_digest is None:
             return self.__class__(**self._kwargs)
+        self.change_set = {}
         if self._current_text_digest != self._db_hash_digest:
             self._db_hash_digest = self._current_text_digest
-            self._finalize(self._current_text)
+            self._db_change_token = self._current_change_token
+            old_base_dir = self._base_dir
+            prepared, self._prepared_tree = self._prepared_tree, None
+            if prepared is not None and prepared[0] == self._current_text_digest:
+                self._base_dir, self._dir_index = prepared[1]
+            else:
+                self._finalize(self._current_text)
+            self._base_dir.record_changes_since(old_base_dir, self.change_set)
+            self._file_name_index = None
         return self
+    def close(self):
+        pass
+    def find_file_paths(self, query, max_results=20):
+        """Return the paths of the files in the db that best match "query"
+        (best first)
+        """
+        # NB: the tree is small and complete so the index is just rebuilt
+        # (when next needed) whenever the tree is
+        if self._file_name_index is None:
+            self._file_name_index = FileNameIndex()
+            for file_dir in self._base_dir._iter_dirs():
+                for fdata in file_dir._files_data:
+                    self._file_name_index.add_file(file_dir.data.path, fdata.name)
+        return self._file_name_index.search(query, max_results)
+    # See GenericSnapshotWsFileDb._get_change_token() e.g. the stat() of a patch series file
+    def _get_change_token(self):
+        return None
+    def _get_patch_data(self, h):
+        chunks = self._get_patch_data_chunks()
+        if chunks is None:
+            return self._get_patch_data_text(h)
+        return self._extract_patch_data_from_records(iter_nul_records(chunks, h))
     def _get_patch_data_text(self, h):
         assert False, "_get_patch_data_text() must be defined in child"
+    # Streaming alternative to _get_patch_data_text() (see GenericSnapshotWsFileDb)
+    # whose result is what's passed to _iterate_file_data()
+    def _get_patch_data_chunks(self):
+        return None
+    def _extract_patch_data_from_records(self, records):
+        assert False, "_extract_patch_data_from_records() must be defined in child if streaming"
     @staticmethod
     def _iterate_file_data(pdt):
         assert False, "iterate_file_data() must be defined in child"
+    def find_dir(self, dir_path):
+        """Return the FileDir for "dir_path" (or None if it isn't in the db)"""
+        return self._dir_index.get(_normalized_relpath(dir_path), None)
+    def get_dir_stats(self, dir_path=""):
+        """Return the DirStats for "dir_path" (or None if unknown)"""
+        tdir = self.find_dir(dir_path)
+        return tdir.stats if tdir else None
     def dir_contents(self, dir_path="", hide_clean=False, **kwargs):
-        tdir = self._base_dir.find_dir(dir_path)
+        tdir = self.find_dir(dir_path)
         if not tdir:
             return ([], [])
         return tdir.dirs_and_files(hide_clean=hide_clean, **kwargs)
+    def get_dir_view(self, dir_path="", hide_clean=False, **kwargs):
+        tdir = self.find_dir(dir_path)
+        if not tdir:
+            return ([], [])
+        return tdir.get_view(hide_clean=hide_clean, **kwargs)
+    @staticmethod
+    def get_unpopulated_subdirs(dir_path="", **kwargs):
+        # NB: the whole tree is built up front
+        return []
 
 class GenericTopPatchFileDb(GenericChangeFileDb):
     def __init__(self):
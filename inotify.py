@@ -0,0 +1,152 @@
+### Copyright (C) 2016 Peter Williams <pwil3058@gmail.com>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Minimal (ctypes based) access to Linux's inotify facility for
+detecting changes to the contents of directories.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+# the events that change a directory's list of entries
+DIR_CHANGE_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT_HDR = struct.Struct("iIII")
+
+def _get_libc():
+    if not os.uname().sysname == "Linux":
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        for name in ["inotify_init1", "inotify_add_watch", "inotify_rm_watch"]:
+            getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+_LIBC = _get_libc()
+
+AVAILABLE = _LIBC is not None
+
+class DirWatcher:
+    """Watch a collection of directories (each identified by a caller
+    supplied key) and report which of them have had their entries change.
+    """
+    def __init__(self):
+        self._fd = -1
+        if not AVAILABLE:
+            raise OSError(errno.ENOSYS, _("inotify is not available"))
+        self._fd = _LIBC.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            eno = ctypes.get_errno()
+            raise OSError(eno, os.strerror(eno))
+        # NB: the kernel gives the same watch descriptor to every watch
+        # of a directory (e.g. via a symbolic link) so it may have
+        # several keys
+        self._keys_for_wd = {}
+        self._wd_for_key = {}
+        self.overflowed = False
+    def add_watch(self, dir_path, key):
+        """Start watching "dir_path" on behalf of "key".  Return False if
+        the watch could not be established (e.g. the user's watch limit
+        has been reached) and the caller should fall back to polling.
+        """
+        wd = _LIBC.inotify_add_watch(self._fd, os.fsencode(dir_path), DIR_CHANGE_MASK | IN_ONLYDIR)
+        if wd < 0:
+            return False
+        old_wd = self._wd_for_key.get(key, None)
+        if old_wd is not None and old_wd != wd:
+            # e.g. the directory has been replaced
+            self.remove_watches((key,))
+        self._keys_for_wd.setdefault(wd, set()).add(key)
+        self._wd_for_key[key] = wd
+        return True
+    def remove_watches(self, keys):
+        for key in keys:
+            wd = self._wd_for_key.pop(key, None)
+            if wd is None:
+                continue
+            wd_keys = self._keys_for_wd[wd]
+            wd_keys.discard(key)
+            if not wd_keys:
+                # NB: the watch is only removed with its last key
+                _LIBC.inotify_rm_watch(self._fd, wd)
+                del self._keys_for_wd[wd]
+    def remove_all_watches(self):
+        for wd in self._keys_for_wd:
+            _LIBC.inotify_rm_watch(self._fd, wd)
+        self._keys_for_wd = {}
+        self._wd_for_key = {}
+        # discard anything already queued for the old watches
+        self._read_raw_events()
+        self.overflowed = False
+    def _read_raw_events(self):
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+    def read_changed_keys(self):
+        """Return the set of keys whose directories have changed since
+        the last call (without blocking).  If the kernel's event queue
+        overflowed "overflowed" is set as events will have been lost.
+        """
+        keys = set()
+        buf = self._read_raw_events()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _cookie, name_len = _EVENT_HDR.unpack_from(buf, offset)
+            offset += _EVENT_HDR.size + name_len
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            wd_keys = self._keys_for_wd.get(wd, None)
+            if wd_keys is None:
+                continue
+            keys.update(wd_keys)
+            if mask & IN_IGNORED:
+                # the directory has gone (or the watch was removed)
+                del self._keys_for_wd[wd]
+                for key in wd_keys:
+                    del self._wd_for_key[key]
+        return keys
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+            self._keys_for_wd = {}
+            self._wd_for_key = {}
+    def __del__(self):
+        self.close()
@@ -0,0 +1,219 @@
+"""Tests for the inotify based DirWatcher using a temporary directory tree"""
+
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# NB: inotify.py doesn't need GTK so it's imported as a plain module
+# rather than via the package (whose __init__ does)
+_PKG_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _PKG_DIR)
+
+import inotify
+
+# NB: fsdb.py does need GTK and the package that this is a submodule of
+# (for its relative imports) so the tests that use it are skipped if
+# they're not available
+try:
+    _TOP_DIR = os.path.dirname(_PKG_DIR)
+    sys.path.insert(0, os.path.dirname(_TOP_DIR))
+    fsdb = importlib.import_module(".".join([os.path.basename(_TOP_DIR), os.path.basename(_PKG_DIR), "fsdb"]))
+except (ImportError, ValueError):
+    fsdb = None
+
+@unittest.skipUnless(inotify.AVAILABLE, "inotify is not available")
+class DirWatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.top_dir = tempfile.mkdtemp()
+        self.dir_a = os.path.join(self.top_dir, "a")
+        self.dir_b = os.path.join(self.top_dir, "b")
+        os.mkdir(self.dir_a)
+        os.mkdir(self.dir_b)
+        self.watcher = inotify.DirWatcher()
+        self.assertTrue(self.watcher.add_watch(self.dir_a, "a"))
+        self.assertTrue(self.watcher.add_watch(self.dir_b, "b"))
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.top_dir)
+    def test_no_changes(self):
+        self.assertEqual(self.watcher.read_changed_keys(), set())
+    def test_create_file(self):
+        open(os.path.join(self.dir_a, "f"), "w").close()
+        self.assertEqual(self.watcher.read_changed_keys(), {"a"})
+        # NB: the events have been consumed
+        self.assertEqual(self.watcher.read_changed_keys(), set())
+    def test_create_subdir(self):
+        os.mkdir(os.path.join(self.dir_b, "sub"))
+        self.assertEqual(self.watcher.read_changed_keys(), {"b"})
+    def test_modify_file_is_not_a_dir_change(self):
+        file_path = os.path.join(self.dir_a, "f")
+        open(file_path, "w").close()
+        self.watcher.read_changed_keys()
+        with open(file_path, "w") as f_obj:
+            f_obj.write("contents")
+        self.assertEqual(self.watcher.read_changed_keys(), set())
+    def test_rename_within_dir(self):
+        open(os.path.join(self.dir_a, "f"), "w").close()
+        self.watcher.read_changed_keys()
+        os.rename(os.path.join(self.dir_a, "f"), os.path.join(self.dir_a, "g"))
+        self.assertEqual(self.watcher.read_changed_keys(), {"a"})
+    def test_rename_between_dirs(self):
+        open(os.path.join(self.dir_a, "f"), "w").close()
+        self.watcher.read_changed_keys()
+        os.rename(os.path.join(self.dir_a, "f"), os.path.join(self.dir_b, "f"))
+        self.assertEqual(self.watcher.read_changed_keys(), {"a", "b"})
+    def test_delete_file(self):
+        open(os.path.join(self.dir_b, "f"), "w").close()
+        self.watcher.read_changed_keys()
+        os.remove(os.path.join(self.dir_b, "f"))
+        self.assertEqual(self.watcher.read_changed_keys(), {"b"})
+    def test_delete_watched_dir(self):
+        shutil.rmtree(self.dir_a)
+        self.assertEqual(self.watcher.read_changed_keys(), {"a"})
+        # the kernel drops the watch so it's forgotten
+        self.assertNotIn("a", self.watcher._wd_for_key)
+        open(os.path.join(self.dir_b, "f"), "w").close()
+        self.assertEqual(self.watcher.read_changed_keys(), {"b"})
+    def test_remove_watches(self):
+        self.watcher.remove_watches({"a"})
+        open(os.path.join(self.dir_a, "f"), "w").close()
+        open(os.path.join(self.dir_b, "f"), "w").close()
+        self.assertEqual(self.watcher.read_changed_keys(), {"b"})
+    def test_same_dir_via_symlink(self):
+        # NB: the kernel gives both watches the same watch descriptor
+        link_path = os.path.join(self.top_dir, "alink")
+        os.symlink(self.dir_a, link_path)
+        self.assertTrue(self.watcher.add_watch(link_path, "alink"))
+        open(os.path.join(self.dir_a, "f"), "w").close()
+        self.assertEqual(self.watcher.read_changed_keys(), {"a", "alink"})
+    def test_remove_one_of_shared_watch(self):
+        link_path = os.path.join(self.top_dir, "alink")
+        os.symlink(self.dir_a, link_path)
+        self.watcher.add_watch(link_path, "alink")
+        self.watcher.remove_watches({"a"})
+        open(os.path.join(self.dir_a, "f"), "w").close()
+        self.assertEqual(self.watcher.read_changed_keys(), {"alink"})
+        self.watcher.remove_watches({"alink"})
+        open(os.path.join(self.dir_a, "g"), "w").close()
+        self.assertEqual(self.watcher.read_changed_keys(), set())
+    def test_remove_all_watches_discards_queued_events(self):
+        open(os.path.join(self.dir_a, "f"), "w").close()
+        self.watcher.remove_all_watches()
+        self.assertEqual(self.watcher.read_changed_keys(), set())
+        open(os.path.join(self.dir_b, "f"), "w").close()
+        self.assertEqual(self.watcher.read_changed_keys(), set())
+    def test_close(self):
+        self.watcher.close()
+        self.assertEqual(self.watcher._fd, -1)
+        # closing again is harmless
+        self.watcher.close()
+
+@unittest.skipUnless(inotify.AVAILABLE, "inotify is not available")
+@unittest.skipIf(fsdb is None, "fsdb can't be imported")
+class OsFileDbInotifyTests(unittest.TestCase):
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.top_dir = tempfile.mkdtemp()
+        os.chdir(self.top_dir)
+        for dir_path in ["a", "b", os.path.join("b", "c")]:
+            os.mkdir(dir_path)
+        self.file_db = None
+    def tearDown(self):
+        if self.file_db is not None:
+            self.file_db.close()
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.top_dir)
+    def _new_file_db(self, dir_paths=("", "a", "b", "b/c")):
+        self.file_db = fsdb.OsFileDb(use_inotify=True)
+        for dir_path in dir_paths:
+            self.file_db.dir_contents(dir_path)
+        return self.file_db
+    def _reset(self):
+        self.file_db = self.file_db.reset()
+        return self.file_db
+    def _file_names(self, dir_path):
+        return [fdata.name for fdata in self.file_db.dir_contents(dir_path)[1]]
+    def test_is_watched(self):
+        file_db = self._new_file_db()
+        self.assertIsNotNone(file_db._dir_monitor)
+        self.assertTrue(all(file_db.find_dir(dir_path)._is_watched for dir_path in ["", "a", "b", "b/c"]))
+        self.assertTrue(file_db.is_current)
+    def test_only_changed_dirs_are_dirty(self):
+        file_db = self._new_file_db()
+        open(os.path.join("b", "c", "f"), "w").close()
+        self.assertFalse(file_db.is_current)
+        self.assertEqual([dir_path for dir_path in ["", "a", "b", "b/c"] if file_db.find_dir(dir_path)._is_dirty], ["b/c"])
+        file_db = self._reset()
+        self.assertEqual(set(file_db.change_set), {"./b/c"})
+        self.assertEqual(self._file_names("b/c"), ["f"])
+        self.assertTrue(file_db.is_current)
+    def test_modified_file_is_not_a_change(self):
+        open(os.path.join("a", "f"), "w").close()
+        file_db = self._new_file_db()
+        with open(os.path.join("a", "f"), "w") as f_obj:
+            f_obj.write("contents")
+        self.assertTrue(file_db.is_current)
+    def test_removed_dir(self):
+        file_db = self._new_file_db()
+        shutil.rmtree("b")
+        self.assertFalse(file_db.is_current)
+        file_db = self._reset()
+        self.assertIsNone(file_db.find_dir("b/c"))
+        self.assertEqual([ddata.name for ddata in file_db.dir_contents("")[0]], ["a"])
+        self.assertTrue(file_db.is_current)
+    def test_falls_back_to_polling(self):
+        # e.g. when the user's watch limit has been reached
+        with mock.patch.object(fsdb.inotify.DirWatcher, "add_watch", return_value=False):
+            file_db = self._new_file_db()
+            self.assertFalse(any(file_db.find_dir(dir_path)._is_watched for dir_path in ["", "a", "b", "b/c"]))
+            self.assertTrue(file_db.is_current)
+            open(os.path.join("a", "f"), "w").close()
+            self.assertFalse(file_db.is_current)
+            self._reset()
+            self.assertEqual(self._file_names("a"), ["f"])
+            self.assertTrue(self.file_db.is_current)
+    def test_same_dir_via_symlink(self):
+        os.symlink("a", "alink")
+        file_db = self._new_file_db(["", "a", "alink"])
+        open(os.path.join("a", "f"), "w").close()
+        self.assertFalse(file_db.is_current)
+        self._reset()
+        self.assertEqual(self._file_names("a"), ["f"])
+        self.assertEqual(self._file_names("alink"), ["f"])
+        self.assertTrue(self.file_db.is_current)
+    def test_snapshot_db_rebuild_is_watched(self):
+        statuses = {os.path.join("b", "c", "f"): ("M", None)}
+        class SnapshotFileDb(fsdb.GenericSnapshotWsFileDb):
+            class FileDir(fsdb.GenericSnapshotWsFileDb.FileDir):
+                DIR_DATA = fsdb.DirData
+                FILE_DATA = fsdb.FileData
+            def _get_file_data_text(self, h):
+                h.update(repr(sorted(statuses.items())).encode())
+                return dict(statuses)
+            def _extract_file_status_snapshot(self, file_data):
+                return fsdb.Snapshot(file_data)
+        self.file_db = SnapshotFileDb(use_inotify=True)
+        for dir_path in ["", "b", "b/c"]:
+            self.file_db.dir_contents(dir_path)
+        self.assertIsNotNone(self.file_db._dir_monitor)
+        # the SCM data changes so the tree is rebuilt
+        statuses[os.path.join("b", "c", "f")] = ("A", None)
+        self.assertFalse(self.file_db.is_current)
+        self.file_db.prepare_reset()
+        file_db = self._reset()
+        self.assertTrue(all(file_db.find_dir(dir_path)._is_watched for dir_path in ["", "b", "b/c"]))
+        open(os.path.join("b", "c", "g"), "w").close()
+        self.assertFalse(file_db.is_current)
+        self._reset()
+        self.assertEqual(self._file_names("b/c"), ["f", "g"])
+    def test_close(self):
+        file_db = self._new_file_db()
+        file_db.close()
+        self.assertEqual(file_db._dir_monitor._watcher._fd, -1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -31,6 +31,7 @@ from ..bab import utils
 
 from . import actions
 from . import dialogue
+from . import fsdb
 from . import gutils
 from . import textview
 
@@ -277,22 +278,22 @@ class FileModifyUndoSaveBuffer(ModifyUndoSaveBuffer):
         if file_path:
             self.load_file()
     def load_file(self):
+        # NB: digest first so that a change made while reading is seen as a modification
+        self._hash_digest = fsdb.CONTENT_DIGEST_CACHE.get_digest(self._file_path)
         with open(self._file_path, "r") as f_obj:
-            text = f_obj.read()
-            self._hash_digest = hashlib.sha1(text).digest()
-            self.set_text(text)
+            self.set_text(f_obj.read())
     def save_file(self):
         with open(self._file_path, "w") as f_obj:
             for line in self.get_text(self.get_start_iter(), self.get_end_iter(), True).splitlines(False):
                 f_obj.write(line.rstrip() + "\n")
         self.load_file()
     def get_current_hash_digest(self):
-        return hashlib.sha1(self.get_text(self.get_start_iter(), self.get_end_iter(), True)).digest()
+        return hashlib.sha1(self.get_text(self.get_start_iter(), self.get_end_iter(), True).encode()).digest()
     def get_file_hash_digest(self):
-        if not self._file_path or not os.path.isfile(file_path):
+        # NB: polled periodically so only reread when the file's stat changes
+        if not self._file_path:
             return None
-        with open(self._file_path, "r") as f_obj:
-            return hashlib.sha1(f_obj.read()).digest()
+        return fsdb.CONTENT_DIGEST_CACHE.get_digest(self._file_path)
     @property
     def modified_on_disk(self):
         return self.get_file_hash_digest() != self._hash_digest
@@ -377,8 +377,10 @@ class View(Gtk.TreeView):
     def set_model(self, model):
         assert model is None or isinstance(model, self.MODEL) or isinstance(model.get_model(), self.MODEL)
         old_model = self.get_model()
-        for sig_cb_id in self._change_cb_ids:
-            old_model.disconnect(sig_cb_id)
+        if old_model is not None:
+            for sig_cb_id in self._change_cb_ids:
+                old_model.disconnect(sig_cb_id)
+        self._change_cb_ids = []
         Gtk.TreeView.set_model(self, model)
         if model is not None:
             self._connect_model_changed_cbs()